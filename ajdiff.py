@@ -1,28 +1,136 @@
 # /// script
 # requires-python = ">=3.12"
-# dependencies = ["typer"]
+# dependencies = []
 # ///
 """ajdiff — Local Git PR Diff Viewer.
 
 Generates a GitHub-PR-like diff view in the browser using diff2html.
+
+Startup is on the critical path of every invocation, so the module only
+imports what it needs to run git; heavier stdlib modules (``argparse``,
+``json``, ``tempfile``, ``webbrowser``) are imported where used. When a
+``--daemon`` is running, forwarding to it needs none of them.
 """
 
-import json
+from __future__ import annotations
+
+import os
+import re
 import subprocess
 import sys
-import tempfile
-import webbrowser
+import time
+from collections import namedtuple
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from typing import Annotated, Optional
 
-import typer
-from rich.console import Console
+# typing costs a few ms to import, so it's only loaded by type checkers:
+# annotations stay unevaluated strings and named tuples come from collections.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import argparse
+    from typing import TextIO
+
+# The Python API (see the readme); everything else is internal to the CLI.
+__all__ = ["DiffStats", "FileDiff", "Hunk", "diff_stats", "iter_files", "main", "render_html"]
+
+
+class Console:
+    """Minimal stand-in for ``rich.console.Console`` writing to stderr.
+
+    Understands the handful of markup tags ajdiff uses (``[bold]``,
+    ``[dim]``, ``[red]``, ``[green]``, ``[yellow]`` and ``[/]``) and renders
+    them as ANSI codes when stderr is a terminal, plain text otherwise.
+    """
+
+    STYLES = {"bold": "1", "dim": "2", "red": "31", "green": "32", "yellow": "33"}
+    TAG_RE = re.compile(r"\[(/?)([a-z ]*)\]")
+
+    def __init__(self, file=None) -> None:
+        self.file = file or sys.stderr
+        self.color = self.file.isatty() and "NO_COLOR" not in os.environ
+
+    def _render(self, text: str) -> str:
+        def replace(m: re.Match[str]) -> str:
+            words = m.group(2).split()
+            if any(w not in self.STYLES for w in words):
+                return m.group(0)
+            if not self.color:
+                return ""
+            if m.group(1) or not words:
+                return "\033[0m"
+            return "\033[" + ";".join(self.STYLES[w] for w in words) + "m"
+
+        return self.TAG_RE.sub(replace, text)
+
+    def print(self, text: str) -> None:
+        print(self._render(text), file=self.file)
+
+    @contextmanager
+    def status(self, text: str) -> Iterator[None]:
+        """Show a transient status line while the block runs (terminals only)."""
+        if not self.file.isatty():
+            yield
+            return
+        line = self._render(text)
+        self.file.write(line + "\r")
+        self.file.flush()
+        try:
+            yield
+        finally:
+            self.file.write("\033[2K\r")
+            self.file.flush()
+
+
+console = Console()
+
 
-app = typer.Typer(
-    help="Generate a GitHub-PR-like diff view in the browser.",
-    no_args_is_help=False,
-)
-console = Console(stderr=True)
+class Profiler:
+    """Per-phase wall time, plus memory when enabled (``--profile``).
+
+    Wall times are always recorded (they are cheap and get embedded in the
+    page). Memory tracking uses tracemalloc, which slows allocation-heavy
+    code noticeably, so it only runs when ``enabled`` is set.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.phases: list[dict[str, object]] = []
+        if enabled:
+            import tracemalloc
+
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        if self.enabled:
+            import tracemalloc
+
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            entry: dict[str, object] = {"name": name, "seconds": round(time.perf_counter() - start, 6)}
+            if self.enabled:
+                entry["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+            self.phases.append(entry)
+
+    def report(self) -> dict[str, object]:
+        report: dict[str, object] = {
+            "total_seconds": round(time.perf_counter() - self.start, 6),
+            "phases": self.phases,
+        }
+        try:
+            import resource
+        except ImportError:  # Windows
+            return report
+        # ru_maxrss is KiB on Linux and bytes on macOS.
+        scale = 1 if sys.platform == "darwin" else 1024
+        report["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        report["children_peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+        return report
 
 HTML_TEMPLATE = """\
 <!DOCTYPE html>
@@ -526,6 +634,32 @@ kbd {{
   transform: translateX(-50%) translateY(0);
 }}
 
+/* === Debug overlay (Shift-D) === */
+.aj-debug-overlay {{
+  position: fixed;
+  right: 12px;
+  bottom: 12px;
+  z-index: 250;
+  min-width: 260px;
+  padding: 8px 10px;
+  font-size: 11px;
+  font-family: var(--mono);
+  background: var(--sidebar-bg);
+  border: 1px solid var(--border);
+  border-radius: var(--radius);
+  box-shadow: var(--shadow-md);
+  white-space: pre;
+  display: none;
+}}
+.aj-debug-overlay.visible {{
+  display: block;
+}}
+.aj-debug-overlay div {{
+  display: flex;
+  justify-content: space-between;
+  gap: 16px;
+}}
+
 /* === diff2html overrides === */
 
 /* Hide diff2html's built-in file list — we have our own sidebar */
@@ -607,6 +741,195 @@ kbd {{
   color: var(--fg-muted) !important;
 }}
 
+/* Files diffed with a fallback strategy (see --max-file-size) */
+.aj-strategy {{
+  margin-left: 8px;
+  padding: 1px 6px;
+  font-size: 10px;
+  font-weight: 600;
+  font-family: var(--sans);
+  border-radius: 4px;
+  color: #9a6700;
+  background: rgba(154,103,0,0.1);
+}}
+[data-theme="dark"] .aj-strategy {{
+  color: #d29922;
+  background: rgba(210,153,34,0.12);
+}}
+/* Context expansion controls on hunk headers */
+.aj-expand {{
+  display: inline-flex;
+  gap: 2px;
+  margin-right: 8px;
+}}
+.aj-expand button {{
+  padding: 0 6px;
+  font-size: 11px;
+  font-family: var(--sans);
+  line-height: 1.5;
+  border: 1px solid var(--border);
+  border-radius: 4px;
+  background: var(--btn-bg);
+  color: var(--fg-muted);
+  cursor: pointer;
+}}
+.aj-expand button:hover {{
+  background: var(--btn-hover);
+  color: var(--fg);
+}}
+.aj-expand-footer {{
+  display: flex;
+  padding: 4px 8px;
+  background: var(--sidebar-bg);
+  border-top: 1px solid var(--border);
+}}
+/* Not-yet-drawn files (see setPlaceholder) */
+.aj-file.aj-placeholder {{
+  border: 1px solid var(--border);
+  border-radius: var(--radius);
+  margin-bottom: 12px;
+  overflow: hidden;
+}}
+.aj-placeholder-name {{
+  padding: 8px 12px;
+  font-size: 12px;
+  font-family: var(--mono);
+  color: var(--fg-muted);
+  background: var(--sidebar-bg);
+  border-bottom: 1px solid var(--border);
+}}
+.aj-summary-note {{
+  padding: 16px;
+  font-size: 12px;
+  color: var(--fg-muted);
+}}
+/* Native renderer (see drawNative): one element per line, line numbers
+   drawn from data-o/data-n, split view as a two-column grid. */
+.aj-lines {{
+  --gutter: 56px;
+  --blame: 0px;
+  font-family: var(--mono);
+  font-size: 12px;
+  line-height: 1.45;
+}}
+.aj-lines.aj-split {{
+  display: grid;
+  grid-template-columns: minmax(0, 1fr) minmax(0, 1fr);
+}}
+.aj-line {{
+  position: relative;
+  min-height: 1.45em;
+  padding: 0 12px 0 calc(var(--gutter) + var(--blame) + 12px);
+  white-space: pre-wrap;
+  overflow-wrap: anywhere;
+}}
+.aj-unified .aj-line {{
+  padding-left: calc(2 * var(--gutter) + var(--blame) + 12px);
+}}
+.aj-split .aj-r {{
+  border-left: 1px solid var(--border);
+}}
+.aj-line::before,
+.aj-unified .aj-line::after {{
+  content: attr(data-blame) " " attr(data-o) attr(data-n);
+  position: absolute;
+  top: 0;
+  bottom: 0;
+  left: 0;
+  width: calc(var(--gutter) + var(--blame));
+  overflow: hidden;
+  white-space: pre;
+  box-sizing: border-box;
+  padding-right: 8px;
+  text-align: right;
+  font-size: 11px;
+  color: var(--fg-muted);
+  background: var(--sidebar-bg);
+  border-right: 1px solid var(--border);
+}}
+.aj-unified .aj-line::before {{
+  content: attr(data-blame) " " attr(data-o);
+}}
+.aj-unified .aj-line::after {{
+  content: attr(data-n);
+  left: calc(var(--gutter) + var(--blame));
+  width: var(--gutter);
+}}
+/* Blame annotations on old-side line numbers (see applyBlame) */
+.aj-blame-on .aj-lines {{
+  --blame: 150px;
+}}
+.aj-split .aj-r {{
+  --blame: 0px;
+}}
+.aj-blame-on .d2h-code-side-linenumber,
+.aj-blame-on .d2h-code-linenumber {{
+  white-space: nowrap;
+}}
+.aj-blame-on .d2h-code-side-linenumber[data-blame]::before,
+.aj-blame-on .d2h-code-linenumber[data-blame]::before {{
+  content: attr(data-blame);
+  float: left;
+  margin-right: 12px;
+  font-size: 10px;
+}}
+.aj-line del,
+.aj-line ins {{
+  text-decoration: none;
+}}
+.aj-hunk {{
+  grid-column: 1 / -1;
+  padding: 0 12px;
+}}
+/* Repeated changes (see duplicateList) */
+.aj-duplicates {{
+  padding: 6px 12px;
+  font-size: 12px;
+  color: var(--fg-muted);
+  background: var(--sidebar-bg);
+  border-bottom: 1px solid var(--border);
+}}
+.aj-duplicates a,
+.aj-summary-note a {{
+  color: var(--active-file-border);
+  font-family: var(--mono);
+}}
+.aj-show-duplicate,
+.aj-plan-full {{
+  margin-left: 4px;
+  padding: 1px 8px;
+  font-size: 11px;
+  font-family: var(--sans);
+  border: 1px solid var(--border);
+  border-radius: 4px;
+  background: var(--btn-bg);
+  color: var(--fg);
+  cursor: pointer;
+}}
+.aj-show-duplicate:hover,
+.aj-plan-full:hover {{
+  background: var(--btn-hover);
+}}
+/* Viewed files (see setViewed) */
+.aj-file .d2h-file-collapse {{
+  display: flex;
+}}
+.aj-viewed-header {{
+  border-bottom: none !important;
+}}
+.aj-viewed-header .d2h-file-name-wrapper {{
+  color: var(--fg-muted);
+  cursor: pointer;
+}}
+.aj-file-item.aj-viewed .aj-file-name {{
+  color: var(--fg-muted);
+  text-decoration: line-through;
+}}
+.aj-viewed-count {{
+  font-weight: normal;
+  color: var(--fg-muted);
+}}
+
 /* === Light theme diff colors === */
 .d2h-del {{
   background-color: #ffebe9 !important;
@@ -624,16 +947,19 @@ kbd {{
 }}
 /* Inline word-level highlights */
 .d2h-del .d2h-code-line-ctn del,
-.d2h-del .d2h-code-side-line del {{
+.d2h-del .d2h-code-side-line del,
+.aj-line.d2h-del del {{
   background-color: rgba(255,80,60,0.28) !important;
 }}
 .d2h-ins .d2h-code-line-ctn ins,
-.d2h-ins .d2h-code-side-line ins {{
+.d2h-ins .d2h-code-side-line ins,
+.aj-line.d2h-ins ins {{
   background-color: rgba(30,170,70,0.25) !important;
 }}
 /* Light mode code text needs to be dark */
 .d2h-code-line,
-.d2h-code-side-line {{
+.d2h-code-side-line,
+.aj-line {{
   color: #1b1f24 !important;
 }}
 
@@ -663,6 +989,14 @@ kbd {{
   background: #0e1116 !important;
   color: #d4dae2 !important;
 }}
+[data-theme="dark"] .aj-line {{
+  color: #d4dae2 !important;
+}}
+[data-theme="dark"] .aj-line::before,
+[data-theme="dark"] .aj-line::after {{
+  background: #151921;
+  color: #4a5163;
+}}
 [data-theme="dark"] .d2h-del {{
   background-color: rgba(248,81,73,0.12) !important;
 }}
@@ -678,11 +1012,13 @@ kbd {{
   background-color: rgba(63,185,80,0.12) !important;
 }}
 [data-theme="dark"] .d2h-del .d2h-code-line-ctn del,
-[data-theme="dark"] .d2h-del .d2h-code-side-line del {{
+[data-theme="dark"] .d2h-del .d2h-code-side-line del,
+[data-theme="dark"] .aj-line.d2h-del del {{
   background-color: rgba(248,81,73,0.28) !important;
 }}
 [data-theme="dark"] .d2h-ins .d2h-code-line-ctn ins,
-[data-theme="dark"] .d2h-ins .d2h-code-side-line ins {{
+[data-theme="dark"] .d2h-ins .d2h-code-side-line ins,
+[data-theme="dark"] .aj-line.d2h-ins ins {{
   background-color: rgba(63,185,80,0.25) !important;
 }}
 [data-theme="dark"] .d2h-info {{
@@ -708,6 +1044,7 @@ kbd {{
       <div class="aj-controls">
         <span class="aj-keys"><kbd>C-p</kbd><kbd>C-n</kbd> nav</span>
         <button class="aj-btn" id="btn-sidebar" onclick="toggleSidebar()" title="Toggle sidebar (b)">Sidebar</button>
+        <button class="aj-btn" id="btn-blame" onclick="toggleBlame()" hidden>Blame</button>
         <button class="aj-btn" id="btn-split" onclick="toggleView()">Split</button>
         <button class="aj-btn" id="btn-theme" onclick="toggleTheme()">Theme</button>
       </div>
@@ -723,6 +1060,7 @@ kbd {{
         <div class="aj-sidebar-section aj-files-section">
           <div class="aj-section-header">
             <span>Files</span>
+            <span class="aj-viewed-count" id="viewed-count"></span>
           </div>
           <div class="aj-section-body" id="file-list"></div>
         </div>
@@ -754,13 +1092,31 @@ kbd {{
   </div>
 </div>
 <div class="aj-toast" id="toast"></div>
+<div class="aj-debug-overlay" id="debug-overlay"></div>
 
-<script src="https://cdn.jsdelivr.net/npm/diff2html/bundles/js/diff2html-ui.min.js"></script>
+{renderer_script}
 <script>
-const diffString = {diff_json};
+const renderer = {renderer};
+const fileMeta = {files_json};
+const shardFiles = {shards_json};
+// fileData[i] = {{patch, words}}; null until its data block has been parsed
+// (see ajdiffData) or its shard loaded (--shard).
+const fileData = new Array(fileMeta.length).fill(null);
+const embeddedBlobs = {{}};
+const blobUrl = {blob_url};
+const blameUrl = {blame_url};
+const domBudget = {dom_budget};
+const buildProfile = {build_profile};
 const repoRoot = {repo_root};
+const plannedView = {planned_view};
 let currentView = 'side-by-side';
 const mainScroll = document.getElementById('main-scroll');
+// One slot per file; each file is drawn into its own slot so it can be
+// re-drawn on its own (e.g. after expanding context). Slots start as
+// placeholders sized from fileMeta[i].rows and are drawn when they come near
+// the viewport.
+const fileSlots = [];
+const renderedFiles = new Set();
 
 /* === Context menu + toast === */
 (function() {{
@@ -786,9 +1142,7 @@ const mainScroll = document.getElementById('main-scroll');
     e.preventDefault();
 
     const idx = parseInt(fileItem.dataset.index, 10);
-    const wrapper = document.querySelectorAll('.d2h-file-wrapper')[idx];
-    const nameEl = wrapper?.querySelector('.d2h-file-name');
-    contextFilePath = nameEl ? nameEl.textContent.trim() : '';
+    contextFilePath = fileMeta[idx] ? fileMeta[idx].path : '';
 
     menu.style.left = e.clientX + 'px';
     menu.style.top = e.clientY + 'px';
@@ -821,141 +1175,1185 @@ const mainScroll = document.getElementById('main-scroll');
   }});
 }})();
 
-function render(view) {{
-  currentView = view;
-  const targetEl = document.getElementById('diff-container');
-  const config = {{
+function diffConfig() {{
+  return {{
     drawFileList: false,
     fileContentToggle: true,
-    matching: 'lines',
-    outputFormat: view,
-    highlight: true,
+    // Word-level changes are precomputed in Python (fileMeta[i].words);
+    // disable diff2html's own line matching and word diffing.
+    matching: 'none',
+    maxLineLengthHighlight: 0,
+    outputFormat: currentView,
+    // renderFile() highlights, with the language resolved in Python.
+    highlight: false,
     renderNothingWhenEmpty: false,
   }};
-  const ui = new Diff2HtmlUI(targetEl, diffString, config);
-  ui.draw();
-  ui.highlightCode();
+}}
 
-  document.getElementById('btn-split').classList.toggle('active', view === 'side-by-side');
+function renderFile(i) {{
+  if (isViewed(i) && !openedViewed.has(i)) return renderCollapsed(i);
+  const slot = fileSlots[i];
+  const meta = fileMeta[i];
+  const data = fileData[i];
+  if (!data) return;
+  if (!data.patch) return shownDuplicates.has(i) ? showDuplicate(i) : renderDuplicate(i);
+  if (planned(i, 'collapsed')) return renderPlanned(i);
+  const patch = expandedPatches[i] || data.patch;
+  const highlight = !isViewed(i) && !planned(i, 'highlight');
+  if (renderer === 'native') {{
+    timed('draw', () => drawNative(slot, i, patch, highlight));
+  }} else {{
+    const lang = highlight ? fileLanguage(i) : null;
+    const ui = new Diff2HtmlUI(slot, patch, {{ ...diffConfig(), highlightLanguages: lang ? {{ [lang]: lang }} : {{}} }}, hljs);
+    timed('draw', () => ui.draw());
+    if (lang) {{
+      slot.querySelector('.d2h-file-wrapper')?.setAttribute('data-lang', lang);
+      timed('highlightCode', () => ui.highlightCode());
+    }}
+  }}
+  if (!planned(i, 'words')) timed('paintWords', () => paintWords(slot, data.words));
+  annotateStrategy(slot, meta);
+  if (meta.lang && highlight && !fileLanguage(i)) {{
+    unhighlighted.add(i);
+  }} else {{
+    unhighlighted.delete(i);
+    const key = cacheKey(i);
+    if (key) cachePut(key, slot.innerHTML);
+  }}
+  finishFile(i);
+}}
 
-  buildFileList();
-  updateCurrentFile();
+// Controls and bookkeeping shared by fresh and cached drawings.
+function finishFile(i) {{
+  const slot = fileSlots[i];
+  addExpanders(i);
+  slot.querySelector('.d2h-file-collapse')?.replaceWith(viewedToggle(i));
+  if (duplicates[i]) slot.querySelector('.d2h-file-header')?.after(duplicateList(i));
+  annotatePlan(i);
+  slot.classList.remove('aj-placeholder');
+  slot.style.height = '';
+  trackNodes(i);
+  if (blameOn) loadBlame(i);
+  if (!performance.getEntriesByName('first-file').length) performance.mark('first-file');
 }}
 
-/* === File tree sidebar === */
-function buildFileList() {{
-  const container = document.getElementById('file-list');
-  container.innerHTML = '';
-  container.style.padding = '4px 14px';
-  const wrappers = document.querySelectorAll('.d2h-file-wrapper');
-
-  // Collect file info
-  const files = [];
-  wrappers.forEach((w, i) => {{
-    const nameEl = w.querySelector('.d2h-file-name');
-    const fullPath = nameEl ? nameEl.textContent.trim() : `File ${{i + 1}}`;
-    const tagEl = w.querySelector('.d2h-tag');
-    const tagText = tagEl ? tagEl.textContent.trim().toUpperCase() : '';
-    let statusCode = 'M';
-    if (tagText.includes('ADDED') || tagText.includes('NEW')) statusCode = 'A';
-    else if (tagText.includes('DELETED') || tagText.includes('REMOVED')) statusCode = 'D';
-    else if (tagText.includes('RENAMED') || tagText.includes('MOVED')) statusCode = 'R';
-    files.push({{ path: fullPath, index: i, status: statusCode }});
-  }});
+/* === Drawn-file cache (IndexedDB) === */
+// Drawn files are kept as HTML keyed by patch hash, view, renderer and
+// language, so a file whose patch is unchanged since an earlier page on
+// this origin (every file:// page shares one) comes back with a single
+// innerHTML instead of being drawn and highlighted again. The least
+// recently used entries are evicted past CACHE_MAX_ENTRIES.
+const CACHE_VERSION = 1;
+const CACHE_MAX_ENTRIES = 5000;
+const CACHE_MAX_HTML = 2 << 20;
+const htmlCache = new Promise(resolve => {{
+  try {{
+    const req = indexedDB.open('ajdiff', CACHE_VERSION);
+    req.onupgradeneeded = () => {{
+      const db = req.result;
+      if (db.objectStoreNames.contains('files')) db.deleteObjectStore('files');
+      db.createObjectStore('files', {{ keyPath: 'key' }}).createIndex('used', 'used');
+    }};
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => resolve(null);
+  }} catch (err) {{
+    resolve(null);  // e.g. storage disabled for file:// pages
+  }}
+}});
 
-  // Build tree structure
-  const root = {{ children: {{}}, files: [] }};
-  files.forEach(f => {{
-    const parts = f.path.split('/');
-    const fileName = parts.pop();
-    let node = root;
-    parts.forEach(p => {{
-      if (!node.children[p]) node.children[p] = {{ children: {{}}, files: [] }};
-      node = node.children[p];
-    }});
-    node.files.push({{ name: fileName, index: f.index, status: f.status }});
+// Not cached: viewed files (unhighlighted), expanded context, and files
+// diffed with a fallback strategy (whose note includes a timing).
+function cacheKey(i) {{
+  const meta = fileMeta[i];
+  if (!meta.hash || meta.strategy || isViewed(i) || expandedPatches[i] || !fileData[i]?.patch) return null;
+  return [meta.hash, currentView, renderer, meta.lang, activePlan(i).join('+')].join(':');
+}}
+
+async function cacheGet(key) {{
+  const db = await htmlCache;
+  if (!db) return null;
+  return new Promise(resolve => {{
+    const store = db.transaction('files', 'readwrite').objectStore('files');
+    const req = store.get(key);
+    req.onsuccess = () => {{
+      const entry = req.result;
+      if (entry) store.put({{ ...entry, used: Date.now() }});
+      resolve(entry ? entry.html : null);
+    }};
+    req.onerror = () => resolve(null);
   }});
+}}
 
-  // Compress single-child directory chains
-  function compress(node) {{
-    const childKeys = Object.keys(node.children);
-    if (childKeys.length === 1 && node.files.length === 0) {{
-      const key = childKeys[0];
-      const child = node.children[key];
-      const compressed = compress(child);
-      return {{ label: key + (compressed.label ? '/' + compressed.label : ''), node: compressed.node }};
-    }}
-    // Recurse into children
-    const newChildren = {{}};
-    Object.keys(node.children).forEach(k => {{
-      const c = compress(node.children[k]);
-      const label = c.label ? k + '/' + c.label : k;
-      newChildren[label] = c.node;
-    }});
-    node.children = newChildren;
-    return {{ label: '', node }};
+async function cachePut(key, html) {{
+  const db = await htmlCache;
+  if (!db || html.length > CACHE_MAX_HTML) return;
+  const store = db.transaction('files', 'readwrite').objectStore('files');
+  store.put({{ key, html, used: Date.now() }});
+  const count = store.count();
+  count.onsuccess = () => {{
+    // Evict a tenth at a time so this doesn't run on every put.
+    let excess = count.result - CACHE_MAX_ENTRIES;
+    if (excess <= 0) return;
+    excess += CACHE_MAX_ENTRIES / 10;
+    store.index('used').openCursor().onsuccess = (e) => {{
+      const cursor = e.target.result;
+      if (!cursor || excess-- <= 0) return;
+      cursor.delete();
+      cursor.continue();
+    }};
+  }};
+}}
+
+// renderFile(), or the file's cached HTML from an earlier drawing.
+async function drawFile(i) {{
+  const key = cacheKey(i);
+  const html = key && await cacheGet(key);
+  // It may have been unloaded, or drawn some other way, while we waited.
+  if (!renderedFiles.has(i) || !fileData[i] || key !== cacheKey(i)) return;
+  if (!html) return renderFile(i);
+  const slot = fileSlots[i];
+  timed('restore', () => {{ slot.innerHTML = html; }});
+  if (renderer === 'diff2html' && currentView === 'side-by-side') {{
+    new Diff2HtmlUI(slot, '', diffConfig(), hljs).synchronisedScroll();
   }}
+  finishFile(i);
+}}
 
-  // Compress from root's children
-  const compressedChildren = {{}};
-  Object.keys(root.children).forEach(k => {{
-    const c = compress(root.children[k]);
-    const label = k + (c.label ? '/' + c.label : '');
-    compressedChildren[label] = c.node;
-  }});
-  root.children = compressedChildren;
+/* === Blame (--serve) === */
+// With the Blame button on, each drawn file's base side is blamed by the
+// server (fileMeta[i].blame is the old blob) and the annotations fill in
+// as git streams them. Results are kept per blob for the page's lifetime.
+const BLAME_LABEL = 21;  // characters that fit the native renderer's gutter
+const blameLines = {{}};
+let blameOn = false;
 
-  // Render tree
-  function renderNode(node, parentEl) {{
-    // Sort: files first, then directories
-    const dirKeys = Object.keys(node.children).sort();
-    const sortedFiles = node.files.sort((a, b) => a.name.localeCompare(b.name));
+function toggleBlame() {{
+  blameOn = !blameOn;
+  document.body.classList.toggle('aj-blame-on', blameOn);
+  document.getElementById('btn-blame').classList.toggle('active', blameOn);
+  if (blameOn) renderedFiles.forEach(i => loadBlame(i));
+}}
 
-    sortedFiles.forEach(f => {{
-      const item = document.createElement('div');
-      item.className = 'aj-file-item';
-      item.dataset.index = f.index;
+async function loadBlame(i) {{
+  const sha = fileMeta[i].blame;
+  if (!sha) return;
+  if (blameLines[sha]) return applyBlame(i);
+  const lines = blameLines[sha] = {{}};
+  try {{
+    const res = await fetch(blameUrl + sha);
+    if (!res.ok) return;
+    const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+    let rest = '';
+    for (;;) {{
+      const {{ value, done }} = await reader.read();
+      if (done) break;
+      const parts = (rest + value).split('\\n');
+      rest = parts.pop();
+      parts.forEach(part => {{
+        const entry = JSON.parse(part);
+        for (let k = 0; k < entry.count; k++) lines[entry.line + k] = entry;
+      }});
+      renderedFiles.forEach(j => {{ if (fileMeta[j].blame === sha) applyBlame(j); }});
+    }}
+  }} catch (err) {{
+    console.error(err);
+  }}
+}}
 
-      const nameSpan = document.createElement('span');
-      nameSpan.className = 'aj-file-name';
-      nameSpan.textContent = f.name;
-      item.appendChild(nameSpan);
+function applyBlame(i) {{
+  const lines = blameLines[fileMeta[i].blame];
+  if (!lines) return;
+  const slot = fileSlots[i];
+  const mark = (el, n) => {{
+    const e = lines[n];
+    if (!e || el.dataset.blame) return;
+    const date = new Date(e.time * 1000).toISOString().slice(0, 10);
+    el.dataset.blame = (date + ' ' + e.author).slice(0, BLAME_LABEL);
+    el.title = `${{e.commit}} ${{e.author}}, ${{date}}\\n${{e.summary}}`;
+  }};
+  slot.querySelectorAll('.aj-line[data-o]').forEach(el => {{ if (el.dataset.o) mark(el, el.dataset.o); }});
+  // Split view: the left table holds the old side. Unified: the first number.
+  slot.querySelector('.d2h-file-side-diff')?.querySelectorAll('td.d2h-code-side-linenumber')
+    .forEach(el => mark(el, el.textContent.trim()));
+  slot.querySelectorAll('td.d2h-code-linenumber').forEach(el => {{
+    const n = el.querySelector('.line-num1')?.textContent.trim();
+    if (n) mark(el, n);
+  }});
+}}
 
-      const badge = document.createElement('span');
-      badge.className = 'aj-file-status status-' + f.status;
-      badge.textContent = f.status;
-      item.appendChild(badge);
+/* === Repeated changes === */
+// Files making the same change as an earlier one (fileMeta[i].same) arrive
+// with just their header and @@ lines. They are drawn as a stub pointing at
+// that file and rebuilt from its hunks when opened: Python masked each
+// file's name (fileStem) before comparing, so swapping names back is exact.
+const duplicates = {{}};
+fileMeta.forEach((m, i) => {{ if (m.same !== null) (duplicates[m.same] ||= []).push(i); }});
+const shownDuplicates = new Set();
+const MAX_DUPLICATES_LISTED = 20;
 
-      item.addEventListener('click', () => {{
-        wrappers[f.index].scrollIntoView({{ behavior: 'smooth', block: 'start' }});
-      }});
-      parentEl.appendChild(item);
-    }});
+function fileStem(path) {{
+  const name = path.slice(path.lastIndexOf('/') + 1);
+  const dot = name.lastIndexOf('.');
+  const stem = dot > 0 ? name.slice(0, dot) : name;
+  return stem.length >= 3 ? stem : null;
+}}
 
-    dirKeys.forEach(dirName => {{
-      const dirEl = document.createElement('div');
-      dirEl.className = 'aj-tree-dir';
+function fileLink(j) {{
+  const a = document.createElement('a');
+  a.href = '#';
+  a.textContent = fileMeta[j].path;
+  a.addEventListener('click', (e) => {{
+    e.preventDefault();
+    fileSlots[j].scrollIntoView({{ behavior: 'smooth', block: 'start' }});
+  }});
+  return a;
+}}
 
-      const header = document.createElement('div');
-      header.className = 'aj-tree-dir-header';
-      header.innerHTML = '<span class="aj-tree-chevron">&#9660;</span>' + dirName + '/';
-      header.addEventListener('click', () => dirEl.classList.toggle('collapsed'));
+// "Same change in N more files: ..." under the first file's header.
+function duplicateList(i) {{
+  const note = document.createElement('div');
+  note.className = 'aj-duplicates';
+  const others = duplicates[i];
+  note.append(`Same change in ${{others.length}} more file${{others.length === 1 ? '' : 's'}}: `);
+  others.slice(0, MAX_DUPLICATES_LISTED).forEach((j, k) => {{
+    if (k) note.append(', ');
+    note.append(fileLink(j));
+  }});
+  if (others.length > MAX_DUPLICATES_LISTED) note.append(` and ${{others.length - MAX_DUPLICATES_LISTED}} more`);
+  return note;
+}}
 
-      const childrenEl = document.createElement('div');
-      childrenEl.className = 'aj-tree-children';
-      renderNode(node.children[dirName], childrenEl);
+function renderDuplicate(i) {{
+  const slot = fileSlots[i];
+  const header = document.createElement('div');
+  header.className = 'd2h-file-header';
+  const name = document.createElement('span');
+  name.className = 'd2h-file-name-wrapper';
+  name.textContent = fileMeta[i].path;
+  header.append(name, viewedToggle(i));
+  const note = document.createElement('div');
+  note.className = 'aj-summary-note';
+  const show = document.createElement('button');
+  show.className = 'aj-show-duplicate';
+  show.textContent = 'Show diff';
+  show.addEventListener('click', () => {{
+    shownDuplicates.add(i);
+    showDuplicate(i);
+  }});
+  note.append('Same change as ', fileLink(fileMeta[i].same), '. ', show);
+  const wrapper = document.createElement('div');
+  wrapper.className = 'd2h-file-wrapper';
+  wrapper.append(header, note);
+  slot.replaceChildren(wrapper);
+  slot.classList.remove('aj-placeholder');
+  slot.style.height = '';
+  trackNodes(i);
+}}
 
-      dirEl.appendChild(header);
-      dirEl.appendChild(childrenEl);
-      parentEl.appendChild(dirEl);
-    }});
+// Rebuild file i's patch and word ranges from the file it repeats.
+async function showDuplicate(i) {{
+  const j = fileMeta[i].same;
+  if (!fileData[j]) {{
+    try {{
+      await loadShard(fileMeta[j].shard);
+    }} catch (err) {{
+      console.error(err);
+      return;
+    }}
   }}
-  renderNode(root, container);
+  const data = fileData[i];
+  if (!data || !fileData[j]) return;
+  const from = fileStem(fileMeta[j].path);
+  const to = fileStem(fileMeta[i].path) || '';
+  const hunks = parsePatch(fileData[j].patch).hunks;
+  const out = [...data.header];
+  hunks.forEach((h, k) => {{
+    let body = h.lines.join('\\n');
+    if (from) body = body.split(from).join('\\0');
+    out.push(data.hunks[k], body.split('\\0').join(to));
+  }});
+  data.patch = out.join('\\n') + '\\n';
+  // Line numbers shift by each hunk's offset; column ranges only hold
+  // when the names being swapped are the same length.
+  const words = fileData[j].words;
+  if (words && (from || '').length === to.length) {{
+    const shift = (ranges, start, count, dupStart) => {{
+      const shifted = {{}};
+      Object.keys(ranges).forEach(n => {{
+        const k = hunks.findIndex(h => n >= h[start] && n < h[start] + h[count]);
+        if (k >= 0) shifted[+n + dupStart[k] - hunks[k][start]] = ranges[n];
+      }});
+      return shifted;
+    }};
+    const starts = data.hunks.map(line => HUNK_RE.exec(line));
+    data.words = {{
+      del: shift(words.del, 'oldStart', 'oldCount', starts.map(m => +m[1])),
+      ins: shift(words.ins, 'newStart', 'newCount', starts.map(m => +m[3])),
+    }};
+  }}
+  renderFile(i);
+}}
+
+/* === Render plan === */
+// Python starts large files out cheaper to draw: fileMeta[i].plan maps each
+// downgrade to its reason. The file header says what was left out, and
+// "Draw in full" drops the plan for that file.
+const PLAN_LABELS = {{ collapsed: 'collapsed', highlight: 'no highlighting', words: 'no word diff' }};
+const planOverrides = new Set();
+
+function activePlan(i) {{
+  const plan = fileMeta[i].plan;
+  return plan && !planOverrides.has(i) ? Object.keys(plan) : [];
+}}
+
+function planned(i, step) {{
+  return activePlan(i).includes(step);
+}}
+
+function drawInFull(i) {{
+  planOverrides.add(i);
+  renderedFiles.delete(i);
+  ensureFile(i);
+}}
+
+function planButton(i) {{
+  const button = document.createElement('button');
+  button.className = 'aj-plan-full';
+  button.textContent = 'Draw in full';
+  button.addEventListener('click', () => drawInFull(i));
+  return button;
+}}
+
+function annotatePlan(i) {{
+  const steps = activePlan(i);
+  if (!steps.length) return;
+  const badge = document.createElement('span');
+  badge.className = 'aj-strategy';
+  badge.textContent = steps.map(step => PLAN_LABELS[step]).join(' · ');
+  badge.title = steps.map(step => `${{PLAN_LABELS[step]}}: ${{fileMeta[i].plan[step]}}`).join('\\n');
+  fileSlots[i].querySelector('.d2h-file-name-wrapper')?.append(badge, planButton(i));
+}}
+
+function renderPlanned(i) {{
+  const slot = fileSlots[i];
+  const header = document.createElement('div');
+  header.className = 'd2h-file-header';
+  const name = document.createElement('span');
+  name.className = 'd2h-file-name-wrapper';
+  name.textContent = fileMeta[i].path;
+  header.append(name, viewedToggle(i));
+  const note = document.createElement('div');
+  note.className = 'aj-summary-note';
+  note.append(`Large diff (${{fileMeta[i].plan.collapsed}}) not drawn. `, planButton(i));
+  const wrapper = document.createElement('div');
+  wrapper.className = 'd2h-file-wrapper';
+  wrapper.append(header, note);
+  slot.replaceChildren(wrapper);
+  slot.classList.remove('aj-placeholder');
+  slot.style.height = '';
+  trackNodes(i);
+}}
+
+/* === Syntax highlighting === */
+// Languages are resolved in Python (fileMeta[i].lang, null for none), so
+// highlight.js never guesses, and only the grammars this diff uses are
+// loaded. Files drawn before they arrive are redrawn with highlighting.
+const HLJS_URL = 'https://cdn.jsdelivr.net/gh/highlightjs/cdn-release/build/es/';
+const usedLanguages = {languages_json};
+let hljs = null;
+const unhighlighted = new Set();
+
+async function loadHighlighter() {{
+  if (!usedLanguages.length) return;
+  const core = (await import(HLJS_URL + 'core.min.js')).default;
+  const grammars = await Promise.allSettled(usedLanguages.map(l => import(HLJS_URL + 'languages/' + l + '.min.js')));
+  grammars.forEach((g, k) => {{
+    if (g.status === 'fulfilled') core.registerLanguage(usedLanguages[k], g.value.default);
+  }});
+  hljs = core;
+  unhighlighted.forEach(i => {{ if (renderedFiles.has(i) && fileData[i]) renderFile(i); }});
+}}
+
+function fileLanguage(i) {{
+  const lang = fileMeta[i].lang;
+  return hljs && lang && hljs.getLanguage(lang) ? lang : null;
+}}
+
+/* === Native renderer (--renderer native) === */
+// One element per diff line instead of diff2html's table rows, cells and
+// line-number divs: numbers live in data-o/data-n and are drawn by CSS, and
+// split view is a two-column grid whose cells are the lines themselves.
+const HIGHLIGHT_MAX_LINE = 1000;
+const STATUS_TAGS = {{
+  A: ['ADDED', 'd2h-added'], D: ['DELETED', 'd2h-deleted'],
+  R: ['RENAMED', 'd2h-moved'], C: ['COPIED', 'd2h-moved'],
+}};
+
+function escapeHtml(s) {{
+  return s.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+}}
+
+// Hunk headers (strings) and [old, new] line pairs; a side is null where the
+// row has no line. Unified view gives removed and added lines rows of their own.
+function nativeRows(patch, split) {{
+  const rows = [];
+  parsePatch(patch).hunks.forEach(h => {{
+    rows.push(h.header);
+    let o = h.oldStart, n = h.newStart, dels = [], adds = [];
+    const flush = () => {{
+      if (split) {{
+        for (let j = 0; j < Math.max(dels.length, adds.length); j++) rows.push([dels[j] || null, adds[j] || null]);
+      }} else {{
+        dels.forEach(d => rows.push([d, null]));
+        adds.forEach(a => rows.push([null, a]));
+      }}
+      dels = [];
+      adds = [];
+    }};
+    h.lines.forEach(line => {{
+      const text = line.slice(1);
+      if (line[0] === '-') dels.push({{ kind: 'd2h-del', o: o++, text }});
+      else if (line[0] === '+') adds.push({{ kind: 'd2h-ins', n: n++, text }});
+      else if (line[0] !== '\\\\') {{
+        flush();
+        const cell = {{ kind: 'd2h-cntx', o: o++, n: n++, text }};
+        rows.push([cell, cell]);
+      }}
+    }});
+    flush();
+  }});
+  return rows;
+}}
+
+function nativeLines(rows, split, language) {{
+  const code = (cell) => cell.html ??= language && cell.text.length <= HIGHLIGHT_MAX_LINE
+    ? hljs.highlight(cell.text, {{ language, ignoreIllegals: true }}).value
+    : escapeHtml(cell.text);
+  return rows.map(row => {{
+    if (typeof row === 'string') return `<div class="aj-hunk d2h-info">${{escapeHtml(row)}}</div>`;
+    const [a, b] = row;
+    if (!split) {{
+      const cell = a || b;
+      return `<div class="aj-line ${{cell.kind}}" data-o="${{a ? a.o : ''}}" data-n="${{b ? b.n : ''}}">${{code(cell)}}</div>`;
+    }}
+    return (a ? `<div class="aj-line ${{a.kind}}" data-o="${{a.o}}">${{code(a)}}</div>` : '<div class="aj-line d2h-emptyplaceholder"></div>')
+      + (b ? `<div class="aj-line aj-r ${{b.kind}}" data-n="${{b.n}}">${{code(b)}}</div>` : '<div class="aj-line aj-r d2h-emptyplaceholder"></div>');
+  }}).join('');
+}}
+
+// Same card, header and classes as diff2html, so styles, badges, expanders
+// and the viewed toggle apply unchanged.
+function drawNative(slot, i, patch, highlight) {{
+  const meta = fileMeta[i];
+  const split = currentView === 'side-by-side';
+  const [tag, tagClass] = STATUS_TAGS[meta.status] || ['CHANGED', 'd2h-changed'];
+  const name = meta.old_path ? `${{meta.old_path}} \u2192 ${{meta.path}}` : meta.path;
+  const rows = nativeRows(patch, split);
+  const empty = /^Binary files /m.test(patch) ? 'Binary files differ.'
+    : meta.old_path ? 'File renamed without changes.' : 'File without changes.';
+  const body = rows.length
+    ? `<div class="aj-lines aj-${{split ? 'split' : 'unified'}}">${{nativeLines(rows, split, highlight && fileLanguage(i))}}</div>`
+    : `<div class="aj-lines"><div class="aj-summary-note">${{empty}}</div></div>`;
+  slot.innerHTML = '<div class="d2h-wrapper"><div class="d2h-file-wrapper"><div class="d2h-file-header">'
+    + `<span class="d2h-file-name-wrapper"><span class="d2h-file-name">${{escapeHtml(name)}}</span>`
+    + `<span class="d2h-tag ${{tagClass}} ${{tagClass}}-tag">${{tag}}</span></span>`
+    + `<label class="d2h-file-collapse"></label></div>${{body}}</div></div>`;
+}}
+
+/* === On-demand rendering === */
+const ROW_HEIGHT = 17.4;  // 12px * 1.45 line-height
+const FILE_CHROME = 58;   // file header + card margins
+const RENDER_MARGIN = 1500;
+
+function setPlaceholder(i) {{
+  const slot = fileSlots[i];
+  const rows = isViewed(i) || planned(i, 'collapsed') ? 0 : fileMeta[i].rows[currentView === 'side-by-side' ? 1 : 0];
+  const label = document.createElement('div');
+  label.className = 'aj-placeholder-name';
+  label.textContent = fileMeta[i].path;
+  slot.replaceChildren(label);
+  slot.classList.add('aj-placeholder');
+  slot.style.height = Math.round(FILE_CHROME + rows * ROW_HEIGHT) + 'px';
+}}
+
+// Forget that file i was drawn; the observer redraws it if it is in range.
+function resetFile(i) {{
+  renderedFiles.delete(i);
+  untrackNodes(i);
+  setPlaceholder(i);
+  renderObserver.unobserve(fileSlots[i]);
+  renderObserver.observe(fileSlots[i]);
+}}
+
+async function ensureFile(i) {{
+  if (renderedFiles.has(i)) return;
+  renderedFiles.add(i);
+  if (!fileData[i] && !(isViewed(i) && !openedViewed.has(i))) {{
+    // Still being parsed; ajdiffData() draws it when it arrives.
+    if (fileMeta[i].shard === null) return;
+    try {{
+      await loadShard(fileMeta[i].shard);
+    }} catch (err) {{
+      console.error(err);
+      renderedFiles.delete(i);
+      return;
+    }}
+    // Its shard may have been evicted again while others were loading.
+    if (!fileData[i]) return resetFile(i);
+  }}
+  await drawFile(i);
+  updateCurrentFile();
+}}
+
+const renderObserver = new IntersectionObserver((entries) => {{
+  entries.forEach(e => {{ if (e.isIntersecting) ensureFile(+e.target.dataset.index); }});
+}}, {{ root: mainScroll, rootMargin: RENDER_MARGIN + 'px 0px' }});
+
+/* === DOM recycling (--dom-budget) === */
+// Once drawn files add up to more than domBudget elements, the ones farthest
+// from the viewport go back to placeholders of their drawn height (so nothing
+// shifts) until they are down to 80% of it. They are redrawn from fileData,
+// or their reloaded shard, when they come back into range.
+const fileNodes = new Map();
+let liveNodes = 0;
+
+function trackNodes(i) {{
+  const n = fileSlots[i].getElementsByTagName('*').length;
+  liveNodes += n - (fileNodes.get(i) || 0);
+  fileNodes.set(i, n);
+  if (domBudget > 0 && liveNodes > domBudget) recycleFiles();
+}}
+
+function untrackNodes(i) {{
+  liveNodes -= fileNodes.get(i) || 0;
+  fileNodes.delete(i);
+}}
+
+function recycleFiles() {{
+  const view = mainScroll.getBoundingClientRect();
+  const far = [];
+  fileNodes.forEach((_, i) => {{
+    const r = fileSlots[i].getBoundingClientRect();
+    const distance = Math.max(view.top - r.bottom, r.top - view.bottom);
+    if (distance > RENDER_MARGIN && !prefetchTargets.includes(i) && i !== hoveredFile) far.push([distance, i, r.height]);
+  }});
+  far.sort((a, b) => b[0] - a[0]);
+  for (const [, i, height] of far) {{
+    if (liveNodes <= domBudget * 0.8) break;
+    resetFile(i);
+    fileSlots[i].style.height = Math.round(height) + 'px';
+  }}
+}}
+
+/* === Idle prefetch === */
+// Files are otherwise drawn only once they come within RENDER_MARGIN, so
+// jumping past a long file (Ctrl-n, a sidebar click) waits for the next
+// one to draw. While the page is idle, draw the next few files in the
+// direction the reader is moving, and first any file hovered in the
+// sidebar. One file per idle callback, so input is never kept waiting.
+const PREFETCH_AHEAD = 3;
+const PREFETCH_MIN_IDLE = 10;  // ms left in the idle period to start a draw
+const whenIdle = window.requestIdleCallback
+  || (cb => setTimeout(() => cb({{ timeRemaining: () => PREFETCH_MIN_IDLE }}), 50));
+let prefetchTargets = [];
+let hoveredFile = null;
+let prefetchScheduled = false;
+let travelFrom = 0;
+
+// File i and the PREFETCH_AHEAD after it, going by step (1 or -1).
+function prefetchFrom(i, step) {{
+  prefetchTargets = [];
+  for (let k = 0; k <= PREFETCH_AHEAD; k++) {{
+    if (i + k * step >= 0 && i + k * step < fileMeta.length) prefetchTargets.push(i + k * step);
+  }}
+  schedulePrefetch();
+}}
+
+function trackTravel(i) {{
+  if (i === travelFrom) return;
+  prefetchFrom(i, i > travelFrom ? 1 : -1);
+  travelFrom = i;
+}}
+
+function prefetchHover(i) {{
+  hoveredFile = i;
+  schedulePrefetch();
+}}
+
+function schedulePrefetch() {{
+  if (prefetchScheduled) return;
+  prefetchScheduled = true;
+  whenIdle(runPrefetch);
+}}
+
+function runPrefetch(deadline) {{
+  prefetchScheduled = false;
+  const queue = hoveredFile === null ? prefetchTargets : [hoveredFile, ...prefetchTargets];
+  const i = queue.find(j => !renderedFiles.has(j));
+  if (i === undefined) return;
+  if (deadline.timeRemaining() < PREFETCH_MIN_IDLE) return schedulePrefetch();
+  ensureFile(i).finally(schedulePrefetch);
+}}
+
+/* === Viewed files === */
+// "Viewed" marks are remembered per path and (old blob, new blob) pair
+// (fileMeta[i].key), so a file stays viewed across runs until its diff changes. Viewed files are
+// drawn as a bare header; opening one draws it without syntax highlighting.
+const VIEWED_KEY = 'ajdiff-viewed';
+const MAX_VIEWED = 5000;
+const openedViewed = new Set();
+let viewedStore = {{}};
+try {{
+  viewedStore = JSON.parse(localStorage.getItem(VIEWED_KEY)) || {{}};
+}} catch (err) {{}}
+
+function isViewed(i) {{
+  return fileMeta[i].key in viewedStore;
+}}
+
+function setViewed(i, viewed) {{
+  if (viewed) viewedStore[fileMeta[i].key] = Date.now();
+  else delete viewedStore[fileMeta[i].key];
+  // Keep the store bounded; drop the oldest marks first.
+  const keys = Object.keys(viewedStore);
+  if (keys.length > MAX_VIEWED) {{
+    keys.sort((a, b) => viewedStore[a] - viewedStore[b])
+      .slice(0, keys.length - MAX_VIEWED)
+      .forEach(k => delete viewedStore[k]);
+  }}
+  localStorage.setItem(VIEWED_KEY, JSON.stringify(viewedStore));
+  openedViewed.delete(i);
+  if (viewed) {{
+    renderCollapsed(i);
+    const slot = fileSlots[i];
+    if (slot.getBoundingClientRect().top < mainScroll.getBoundingClientRect().top) slot.scrollIntoView({{ block: 'start' }});
+  }} else {{
+    resetFile(i);
+  }}
+  updateViewed();
+}}
+
+function viewedToggle(i) {{
+  const label = document.createElement('label');
+  label.className = 'd2h-file-collapse' + (isViewed(i) ? ' d2h-selected' : '');
+  const input = document.createElement('input');
+  input.type = 'checkbox';
+  input.className = 'd2h-file-collapse-input';
+  input.checked = isViewed(i);
+  input.addEventListener('change', () => setViewed(i, input.checked));
+  label.append(input, ' Viewed');
+  return label;
+}}
+
+function renderCollapsed(i) {{
+  const slot = fileSlots[i];
+  const header = document.createElement('div');
+  header.className = 'd2h-file-header aj-viewed-header';
+  const name = document.createElement('span');
+  name.className = 'd2h-file-name-wrapper';
+  name.textContent = fileMeta[i].path;
+  name.title = 'Show diff';
+  name.addEventListener('click', () => {{
+    openedViewed.add(i);
+    renderedFiles.delete(i);
+    ensureFile(i);
+  }});
+  header.append(name, viewedToggle(i));
+  const wrapper = document.createElement('div');
+  wrapper.className = 'd2h-file-wrapper';
+  wrapper.appendChild(header);
+  slot.replaceChildren(wrapper);
+  slot.classList.remove('aj-placeholder');
+  slot.style.height = '';
+  trackNodes(i);
+}}
+
+function updateViewed() {{
+  let count = 0;
+  document.querySelectorAll('.aj-file-item').forEach(item => {{
+    const viewed = isViewed(+item.dataset.index);
+    item.classList.toggle('aj-viewed', viewed);
+    count += viewed;
+  }});
+  document.getElementById('viewed-count').textContent = count ? count + ' / ' + fileMeta.length + ' viewed' : '';
+}}
+
+/* === Shards (--shard) === */
+// Each shard is a script calling ajdiffShard(); <script src> works from
+// file:// pages, where fetch() does not. Only the most recently used shards
+// keep their data; evicted shards are reloaded (from the browser cache) if
+// one of their files needs drawing again.
+const MAX_LOADED_SHARDS = 4;
+const shardLoads = new Map();
+
+function loadShard(k) {{
+  if (shardLoads.has(k)) {{
+    const pending = shardLoads.get(k);
+    shardLoads.delete(k);
+    shardLoads.set(k, pending);
+    return pending;
+  }}
+  const pending = new Promise((resolve, reject) => {{
+    const script = document.createElement('script');
+    script.src = shardFiles[k];
+    script.onload = () => {{ script.remove(); resolve(); }};
+    script.onerror = () => {{ script.remove(); shardLoads.delete(k); reject(new Error('failed to load ' + shardFiles[k])); }};
+    document.head.appendChild(script);
+  }});
+  shardLoads.set(k, pending);
+  while (shardLoads.size > MAX_LOADED_SHARDS) {{
+    const oldest = shardLoads.keys().next().value;
+    shardLoads.delete(oldest);
+    fileMeta.forEach((m, i) => {{ if (m.shard === oldest) fileData[i] = null; }});
+  }}
+  return pending;
+}}
+
+function ajdiffShard(k, files, blobs) {{
+  Object.assign(embeddedBlobs, blobs);
+  for (const i in files) fileData[i] = files[i];
+}}
+
+/* === Progressive loading === */
+// Without --shard, file data follows the page shell as <script
+// type="application/json"> chunks, each followed by a call to ajdiffData().
+// The shell and the first files draw while the rest is still being parsed.
+function ajdiffData() {{
+  const el = document.currentScript.previousElementSibling;
+  const chunk = JSON.parse(el.textContent);
+  el.remove();
+  ajdiffShard(null, chunk.files, chunk.blobs);
+  // Files that came into view before their data did.
+  for (const i in chunk.files) {{
+    if (renderedFiles.has(+i)) drawFile(+i);
+  }}
+}}
+
+function render(view) {{
+  currentView = view;
+  performance.mark('render:start');
+  for (const name in phaseTotals) delete phaseTotals[name];
+  const container = document.getElementById('diff-container');
+  if (!fileSlots.length) {{
+    fileMeta.forEach((meta, i) => {{
+      const slot = document.createElement('div');
+      slot.className = 'aj-file';
+      slot.dataset.index = i;
+      container.appendChild(slot);
+      fileSlots.push(slot);
+      renderObserver.observe(slot);
+    }});
+  }}
+  // Redraw files already on screen in the new view; the rest stay placeholders.
+  fileSlots.forEach((slot, i) => {{
+    if (!renderedFiles.has(i)) setPlaceholder(i);
+    else if (fileData[i]) drawFile(i);
+    else resetFile(i);
+  }});
+
+  document.getElementById('btn-split').classList.toggle('active', view === 'side-by-side');
+
+  performance.mark('buildFileList:start');
+  timed('buildFileList', buildFileList);
+  updateViewed();
+  performance.measure('buildFileList', 'buildFileList:start');
+  updateCurrentFile();
+  performance.measure('render', 'render:start');
+  updateDebugOverlay();
+}}
+
+/* === Context expansion === */
+// Expanding context rewrites the file's patch with extra context lines taken
+// from the new-side blob (embedded, or fetched from --serve) and re-draws
+// just that file. Gap k is the unchanged run before hunk k; gap n (after the
+// last hunk) runs to the end of the file.
+const EXPAND_STEP = 20;
+const HUNK_RE = /^@@ -(\\d+)(?:,(\\d+))? \\+(\\d+)(?:,(\\d+))? @@/;
+const expandedPatches = {{}};
+const expandState = {{}};
+const blobCache = {{}};
+
+function getBlobLines(sha) {{
+  if (!blobCache[sha]) {{
+    let text;
+    if (embeddedBlobs[sha]) {{
+      const bytes = Uint8Array.from(atob(embeddedBlobs[sha]), c => c.charCodeAt(0));
+      const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+      text = new Response(stream).text();
+    }} else {{
+      text = fetch(blobUrl + sha).then(r => {{
+        if (!r.ok) throw new Error('blob ' + sha + ': ' + r.status);
+        return r.text();
+      }});
+    }}
+    blobCache[sha] = text.then(t => {{
+      const lines = t.split('\\n');
+      if (lines[lines.length - 1] === '') lines.pop();
+      return lines;
+    }});
+  }}
+  return blobCache[sha];
+}}
+
+function parsePatch(text) {{
+  const lines = text.split('\\n');
+  if (lines[lines.length - 1] === '') lines.pop();
+  const header = [];
+  const hunks = [];
+  let hunk = null;
+  lines.forEach(line => {{
+    const m = HUNK_RE.exec(line);
+    if (m) {{
+      hunk = {{
+        oldStart: +m[1], oldCount: m[2] === undefined ? 1 : +m[2],
+        newStart: +m[3], newCount: m[4] === undefined ? 1 : +m[4],
+        header: line, tail: line.slice(m[0].length), lines: [],
+      }};
+      hunks.push(hunk);
+    }} else if (hunk) {{
+      hunk.lines.push(line);
+    }} else {{
+      header.push(line);
+    }}
+  }});
+  return {{ header, hunks }};
+}}
+
+// Rebuild a patch with the context revealed by state.up[k] (lines above hunk
+// k) and state.down[k] (lines below hunk k-1). Fully revealed gaps merge the
+// hunks on either side. Returns the patch and, for each output hunk, the
+// index of the first original hunk it contains.
+function expandPatch(patch, newLines, state) {{
+  const {{ header, hunks }} = parsePatch(patch);
+  const n = hunks.length;
+  const first = h => h.newCount ? h.newStart : h.newStart + 1;
+  const last = h => h.newCount ? h.newStart + h.newCount - 1 : h.newStart;
+  const oldFirst = h => h.oldCount ? h.oldStart : h.oldStart + 1;
+  const context = (from, to) => newLines.slice(from - 1, Math.max(from - 1, to)).map(l => ' ' + l);
+  const out = [];
+  let prev = null;
+  for (let k = 0; k <= n; k++) {{
+    const gapStart = k === 0 ? 1 : last(hunks[k - 1]) + 1;
+    const gapEnd = k === n ? newLines.length : first(hunks[k]) - 1;
+    const size = Math.max(0, gapEnd - gapStart + 1);
+    const down = prev ? Math.min(state.down[k] || 0, size) : 0;
+    const up = k < n ? Math.min(state.up[k] || 0, size - down) : 0;
+    if (prev) prev.lines.push(...context(gapStart, gapStart + down - 1));
+    if (k === n) break;
+    const h = hunks[k];
+    if (prev && down + up >= size) {{
+      prev.lines.push(...context(gapStart + down, gapEnd), ...h.lines);
+      continue;
+    }}
+    const start = gapEnd - up + 1;
+    prev = {{
+      newStart: start,
+      oldStart: start + oldFirst(h) - first(h),
+      tail: up ? '' : h.tail,
+      lines: [...context(start, gapEnd), ...h.lines],
+      firstHunk: k,
+    }};
+    out.push(prev);
+  }}
+  const text = header.concat(...out.map(h => {{
+    let oldCount = 0;
+    let newCount = 0;
+    h.lines.forEach(l => {{
+      if (l[0] === ' ') {{ oldCount++; newCount++; }}
+      else if (l[0] === '-') oldCount++;
+      else if (l[0] === '+') newCount++;
+    }});
+    const oldStart = oldCount ? h.oldStart : h.oldStart - 1;
+    const newStart = newCount ? h.newStart : h.newStart - 1;
+    return [`@@ -${{oldStart}},${{oldCount}} +${{newStart}},${{newCount}} @@${{h.tail}}`, ...h.lines];
+  }})).join('\\n') + '\\n';
+  return {{ text, firstHunks: out.map(h => h.firstHunk) }};
+}}
+
+async function expandContext(i, gap, direction) {{
+  const meta = fileMeta[i];
+  const state = expandState[i] || (expandState[i] = {{ up: [], down: [], firstHunks: null }});
+  if (direction === 'up' || direction === 'all') state.up[gap] = direction === 'all' ? Infinity : (state.up[gap] || 0) + EXPAND_STEP;
+  if (direction === 'down') state.down[gap] = (state.down[gap] || 0) + EXPAND_STEP;
+  let lines;
+  try {{
+    lines = await getBlobLines(meta.blob);
+  }} catch (err) {{
+    console.error(err);
+    return;
+  }}
+  if (!fileData[i] && fileMeta[i].shard != null) {{
+    try {{
+      await loadShard(fileMeta[i].shard);
+    }} catch (err) {{
+      console.error(err);
+      return;
+    }}
+  }}
+  // Still being parsed, or its shard was evicted again meanwhile.
+  if (!fileData[i]) return;
+  const result = expandPatch(fileData[i].patch, lines, state);
+  expandedPatches[i] = result.text;
+  state.firstHunks = result.firstHunks;
+  renderFile(i);
+}}
+
+function addExpanders(i) {{
+  const meta = fileMeta[i];
+  if (!meta.blob) return;
+  const slot = fileSlots[i];
+  const firstHunks = expandState[i]?.firstHunks;
+  // In split view both sides have a header row per hunk; use the left one.
+  const side = slot.querySelector('.d2h-file-side-diff') || slot;
+  const headers = [...side.querySelectorAll('td.d2h-info .d2h-code-side-line, td.d2h-info .d2h-code-line, .aj-hunk')]
+    .filter(el => el.textContent.trim().startsWith('@@'));
+  headers.forEach((el, j) => {{
+    const gap = firstHunks ? firstHunks[j] : j;
+    const bar = document.createElement('span');
+    bar.className = 'aj-expand';
+    const button = (label, title, direction) => {{
+      const b = document.createElement('button');
+      b.textContent = label;
+      b.title = title;
+      b.addEventListener('click', (e) => {{ e.stopPropagation(); expandContext(i, gap, direction); }});
+      bar.appendChild(b);
+    }};
+    if (gap > 0) button('\u2193', 'Expand down', 'down');
+    button('\u2191', 'Expand up', 'up');
+    button('\u2195', 'Expand all', 'all');
+    el.prepend(bar);
+  }});
+  const body = slot.querySelector('.d2h-files-diff, .d2h-file-diff, .aj-lines');
+  if (body && headers.length) {{
+    const footer = document.createElement('div');
+    footer.className = 'aj-expand aj-expand-footer';
+    const b = document.createElement('button');
+    b.textContent = '\u2193 Expand below';
+    b.addEventListener('click', () => expandContext(i, parsePatch(fileData[i].patch).hunks.length, 'down'));
+    footer.appendChild(b);
+    body.after(footer);
+  }}
+}}
+
+/* === Profiling: performance marks + debug overlay (Shift-D or #debug) === */
+// Per-file phases (draw, highlightCode, ...) run once per file, so they are
+// summed into phaseTotals; whole-page phases also get a performance.measure.
+const phaseTotals = {{}};
+function timed(name, fn) {{
+  const start = performance.now();
+  try {{
+    return fn();
+  }} finally {{
+    phaseTotals[name] = (phaseTotals[name] || 0) + performance.now() - start;
+  }}
+}}
+
+function updateDebugOverlay() {{
+  const overlay = document.getElementById('debug-overlay');
+  if (!overlay.classList.contains('visible')) return;
+  const fmt = (ms) => ms.toFixed(1) + ' ms';
+  const rows = [];
+  rows.push(['python', fmt(buildProfile.total_seconds * 1000)]);
+  buildProfile.phases.forEach(p => rows.push(['  ' + p.name, fmt(p.seconds * 1000)]));
+  if (buildProfile.git && buildProfile.git.rename_detection) {{
+    rows.push(['  (git rename detection)', fmt(buildProfile.git.rename_detection * 1000)]);
+  }}
+  // Latest measure of each name; re-renders (view/theme toggles) add new ones.
+  const latest = {{}};
+  performance.getEntriesByType('measure').forEach(m => {{ latest[m.name] = m; }});
+  rows.push(['browser', latest.render ? fmt(latest.render.duration) : '']);
+  Object.keys(phaseTotals).forEach(name => rows.push(['  ' + name, fmt(phaseTotals[name])]));
+  const firstFile = performance.getEntriesByName('first-file')[0];
+  if (firstFile) rows.push(['  first file drawn', fmt(firstFile.startTime)]);
+  const nav = performance.getEntriesByType('navigation')[0];
+  if (nav) rows.push(['  DOMContentLoaded', fmt(nav.domContentLoadedEventEnd)]);
+  rows.push(['DOM nodes (' + renderer + ')', String(document.getElementsByTagName('*').length)]);
+  if (performance.memory) {{
+    rows.push(['JS heap', (performance.memory.usedJSHeapSize / 1048576).toFixed(1) + ' MB']);
+  }}
+  overlay.replaceChildren(...rows.map(([k, v]) => {{
+    const row = document.createElement('div');
+    const key = document.createElement('span');
+    key.textContent = k;
+    const val = document.createElement('span');
+    val.textContent = v;
+    row.append(key, val);
+    return row;
+  }}));
+}}
+
+function toggleDebug() {{
+  document.getElementById('debug-overlay').classList.toggle('visible');
+  updateDebugOverlay();
+}}
+
+/* === Word-level highlights === */
+// Wrap character ranges [start, end) of el's text in <tag> elements, splitting
+// text nodes as needed so existing syntax-highlight spans are preserved.
+function wrapRanges(el, ranges, tag) {{
+  ranges.forEach(([start, end]) => {{
+    const walker = document.createTreeWalker(el, NodeFilter.SHOW_TEXT);
+    const pieces = [];
+    let pos = 0;
+    let node;
+    while ((node = walker.nextNode()) && pos < end) {{
+      const len = node.nodeValue.length;
+      const s = Math.max(start, pos);
+      const e = Math.min(end, pos + len);
+      if (s < e) pieces.push([node, s - pos, e - pos]);
+      pos += len;
+    }}
+    pieces.forEach(([textNode, s, e]) => {{
+      const mid = s > 0 ? textNode.splitText(s) : textNode;
+      if (e - s < mid.nodeValue.length) mid.splitText(e - s);
+      const mark = document.createElement(tag);
+      mid.parentNode.insertBefore(mark, mid);
+      mark.appendChild(mid);
+    }});
+  }});
+}}
+
+function paintWords(wrapper, words) {{
+  if (!words) return;
+  wrapper.querySelectorAll('td.d2h-del .d2h-code-line-ctn, td.d2h-ins .d2h-code-line-ctn').forEach(ctn => {{
+    const isDel = ctn.closest('td').classList.contains('d2h-del');
+    const numCell = ctn.closest('tr').querySelector('.d2h-code-side-linenumber, .d2h-code-linenumber');
+    if (!numCell) return;
+    // Unified view has separate old/new number columns; split view just one.
+    const numEl = numCell.querySelector(isDel ? '.line-num1' : '.line-num2') || numCell;
+    const ranges = (isDel ? words.del : words.ins)[numEl.textContent.trim()];
+    if (ranges) wrapRanges(ctn, ranges, isDel ? 'del' : 'ins');
+  }});
+  wrapper.querySelectorAll('.aj-line.d2h-del, .aj-line.d2h-ins').forEach(line => {{
+    const isDel = line.classList.contains('d2h-del');
+    const ranges = isDel ? words.del[line.dataset.o] : words.ins[line.dataset.n];
+    if (ranges) wrapRanges(line, ranges, isDel ? 'del' : 'ins');
+  }});
+}}
+
+/* === Fallback strategy badges === */
+function annotateStrategy(wrapper, meta) {{
+  if (!meta || !meta.strategy) return;
+  const badge = document.createElement('span');
+  badge.className = 'aj-strategy';
+  badge.textContent = meta.summarized ? 'summarized' : 'fallback';
+  badge.title = meta.strategy;
+  wrapper.querySelector('.d2h-file-name-wrapper')?.appendChild(badge);
+  if (meta.summarized) {{
+    const body = wrapper.querySelector('.d2h-files-diff, .d2h-file-diff, .aj-lines');
+    if (body) {{
+      const note = document.createElement('div');
+      note.className = 'aj-summary-note';
+      note.textContent = 'Diff not shown (' + meta.strategy.replace(/^summarized: /, '') + ').';
+      body.replaceChildren(note);
+    }}
+  }}
+}}
+
+/* === File tree sidebar === */
+function buildFileList() {{
+  const container = document.getElementById('file-list');
+  container.innerHTML = '';
+  container.style.padding = '4px 14px';
+
+  // Collect file info (copies are badged like renames)
+  const files = fileMeta.map((m, i) => ({{ path: m.path, index: i, status: m.status === 'C' ? 'R' : m.status }}));
+
+  // Build tree structure
+  const root = {{ children: {{}}, files: [] }};
+  files.forEach(f => {{
+    const parts = f.path.split('/');
+    const fileName = parts.pop();
+    let node = root;
+    parts.forEach(p => {{
+      if (!node.children[p]) node.children[p] = {{ children: {{}}, files: [] }};
+      node = node.children[p];
+    }});
+    node.files.push({{ name: fileName, index: f.index, status: f.status }});
+  }});
+
+  // Compress single-child directory chains
+  function compress(node) {{
+    const childKeys = Object.keys(node.children);
+    if (childKeys.length === 1 && node.files.length === 0) {{
+      const key = childKeys[0];
+      const child = node.children[key];
+      const compressed = compress(child);
+      return {{ label: key + (compressed.label ? '/' + compressed.label : ''), node: compressed.node }};
+    }}
+    // Recurse into children
+    const newChildren = {{}};
+    Object.keys(node.children).forEach(k => {{
+      const c = compress(node.children[k]);
+      const label = c.label ? k + '/' + c.label : k;
+      newChildren[label] = c.node;
+    }});
+    node.children = newChildren;
+    return {{ label: '', node }};
+  }}
+
+  // Compress from root's children
+  const compressedChildren = {{}};
+  Object.keys(root.children).forEach(k => {{
+    const c = compress(root.children[k]);
+    const label = k + (c.label ? '/' + c.label : '');
+    compressedChildren[label] = c.node;
+  }});
+  root.children = compressedChildren;
+
+  // Render tree
+  function renderNode(node, parentEl) {{
+    // Sort: files first, then directories
+    const dirKeys = Object.keys(node.children).sort();
+    const sortedFiles = node.files.sort((a, b) => a.name.localeCompare(b.name));
+
+    sortedFiles.forEach(f => {{
+      const item = document.createElement('div');
+      item.className = 'aj-file-item';
+      item.dataset.index = f.index;
+
+      const nameSpan = document.createElement('span');
+      nameSpan.className = 'aj-file-name';
+      nameSpan.textContent = f.name;
+      item.appendChild(nameSpan);
+
+      const badge = document.createElement('span');
+      badge.className = 'aj-file-status status-' + f.status;
+      badge.textContent = f.status;
+      item.appendChild(badge);
+
+      item.addEventListener('click', () => {{
+        fileSlots[f.index].scrollIntoView({{ behavior: 'smooth', block: 'start' }});
+      }});
+      item.addEventListener('mouseenter', () => prefetchHover(f.index));
+      item.addEventListener('mouseleave', () => prefetchHover(null));
+      parentEl.appendChild(item);
+    }});
+
+    dirKeys.forEach(dirName => {{
+      const dirEl = document.createElement('div');
+      dirEl.className = 'aj-tree-dir';
+
+      const header = document.createElement('div');
+      header.className = 'aj-tree-dir-header';
+      header.innerHTML = '<span class="aj-tree-chevron">&#9660;</span>' + dirName + '/';
+      header.addEventListener('click', () => dirEl.classList.toggle('collapsed'));
+
+      const childrenEl = document.createElement('div');
+      childrenEl.className = 'aj-tree-children';
+      renderNode(node.children[dirName], childrenEl);
+
+      dirEl.appendChild(header);
+      dirEl.appendChild(childrenEl);
+      parentEl.appendChild(dirEl);
+    }});
+  }}
+  renderNode(root, container);
 }}
 
 /* === Current file tracking === */
 function updateCurrentFile() {{
-  const wrappers = document.querySelectorAll('.d2h-file-wrapper');
+  const wrappers = fileSlots;
   const items = document.querySelectorAll('.aj-file-item');
   const currentFileEl = document.getElementById('current-file');
   if (!wrappers.length) return;
@@ -978,11 +2376,9 @@ function updateCurrentFile() {{
   }}
 
   // Update header current file
-  const nameEl = wrappers[activeIdx]?.querySelector('.d2h-file-name');
-  if (nameEl) {{
-    currentFileEl.textContent = nameEl.textContent.trim();
-    currentFileEl.classList.add('visible');
-  }}
+  currentFileEl.textContent = fileMeta[activeIdx].path;
+  currentFileEl.classList.add('visible');
+  trackTravel(activeIdx);
 }}
 
 mainScroll.addEventListener('scroll', updateCurrentFile);
@@ -1035,7 +2431,7 @@ function toggleTheme() {{
 /* === Keyboard navigation === */
 document.addEventListener('keydown', (e) => {{
   if (e.target.tagName === 'INPUT' || e.target.tagName === 'TEXTAREA') return;
-  const files = document.querySelectorAll('.d2h-file-wrapper');
+  const files = fileSlots;
   if (!files.length) return;
 
   if ((e.ctrlKey && e.key === 'n') || (e.ctrlKey && e.key === 'p')) {{
@@ -1048,11 +2444,16 @@ document.addEventListener('keydown', (e) => {{
     if (e.key === 'n') target = Math.min(current + 1, files.length - 1);
     else target = Math.max(current - 1, 0);
     files[target].scrollIntoView({{ behavior: 'smooth', block: 'start' }});
+    prefetchFrom(target, e.key === 'n' ? 1 : -1);
   }}
   if (e.key === 'b') {{
     e.preventDefault();
     toggleSidebar();
   }}
+  if (e.key === 'D') {{
+    e.preventDefault();
+    toggleDebug();
+  }}
 }});
 
 /* === Sidebar resize drag === */
@@ -1069,7 +2470,7 @@ document.addEventListener('keydown', (e) => {{
   handle.addEventListener('mousedown', (e) => {{
     e.preventDefault();
     // Remember which file and scroll offset within it
-    const wrappers = document.querySelectorAll('.d2h-file-wrapper');
+    const wrappers = fileSlots;
     const mainTop = main.getBoundingClientRect().top;
     for (let i = 0; i < wrappers.length; i++) {{
       if (wrappers[i].getBoundingClientRect().top <= mainTop) activeFileIdx = i;
@@ -1105,7 +2506,7 @@ document.addEventListener('keydown', (e) => {{
     document.body.style.userSelect = '';
     localStorage.setItem('ajdiff-sidebar-width', sidebar.style.width);
     // Restore scroll to the exact position within the file
-    const wrappers = document.querySelectorAll('.d2h-file-wrapper');
+    const wrappers = fileSlots;
     if (wrappers[activeFileIdx]) {{
       wrappers[activeFileIdx].scrollIntoView({{ block: 'start' }});
       main.scrollTop += scrollOffsetInFile;
@@ -1137,134 +2538,2731 @@ if (savedWidth) {{
   document.getElementById('sidebar').style.width = savedWidth;
 }}
 
-const savedView = localStorage.getItem('ajdiff-view') || 'side-by-side';
+if (location.hash === '#debug') document.getElementById('debug-overlay').classList.add('visible');
+
+const savedView = localStorage.getItem('ajdiff-view') || plannedView || 'side-by-side';
+if (plannedView && !localStorage.getItem('ajdiff-view')) {{
+  document.querySelector('.aj-meta').append(' · unified view for a large diff');
+}}
+if (blameUrl) document.getElementById('btn-blame').hidden = false;
 render(savedView);
+prefetchFrom(0, 1);
+loadHighlighter().catch(console.error);
 adjustHeaderOffset();
 </script>
+{data_blocks}
 </body>
 </html>
 """
 
 
-def git(*args: str) -> subprocess.CompletedProcess[str]:
-    """Run a git command and return the result."""
+def git(
+    *args: str,
+    input: str | None = None,
+    timeout: float | None = None,
+    env: dict[str, str] | None = None,
+) -> subprocess.CompletedProcess[str]:
+    """Run a git command and return the result.
+
+    ``env`` holds variables to set on top of the current environment.
+    """
     return subprocess.run(
         ["git", *args],
         capture_output=True,
         text=True,
+        errors="replace",
+        input=input,
+        timeout=timeout,
+        env={**os.environ, **env} if env else None,
     )
 
 
-def is_git_repo() -> bool:
-    result = git("rev-parse", "--is-inside-work-tree")
-    return result.returncode == 0
+class RepoInfo(namedtuple("RepoInfo", "common_dir root branch")):
+    """The common git dir (a Path), the work tree root ("" in a bare repo) and
+    the branch ("HEAD" when detached; None if unknown)."""
 
+    __slots__ = ()
 
-def get_default_branch() -> str:
-    """Detect the default branch (main, master, etc.)."""
-    # Try the remote HEAD first
-    result = git("symbolic-ref", "refs/remotes/origin/HEAD")
-    if result.returncode == 0:
-        return result.stdout.strip().removeprefix("refs/remotes/origin/")
-    # Fall back to checking common names
-    for name in ("main", "master"):
-        if git("rev-parse", "--verify", name).returncode == 0:
-            return name
-    return "main"
 
+def repo_info() -> RepoInfo | None:
+    """The current repo's paths and branch from a single ``rev-parse``, or None outside a repo.
 
-def get_merge_base(base: str, head: str) -> str | None:
+    ``rev-parse`` prints each answer before it fails on a later one (no work
+    tree, unborn branch), so whatever it printed is still usable.
+    """
+    result = git("rev-parse", "--path-format=absolute", "--git-common-dir", "--show-toplevel", "--abbrev-ref", "HEAD")
+    lines = result.stdout.splitlines()
+    if not lines:
+        return None
+    return RepoInfo(Path(lines[0]), lines[1] if len(lines) > 1 else "", lines[2] if len(lines) > 2 else None)
+
+
+def get_default_branch() -> str:
+    """Detect the default branch (main, master, etc.)."""
+    # The remote HEAD if there is one, else a common name; one git call for all three.
+    result = git(
+        "for-each-ref", "--format=%(refname)%09%(symref)",
+        "refs/remotes/origin/HEAD", "refs/heads/main", "refs/heads/master",
+    )
+    refs = dict(line.split("\t", 1) for line in result.stdout.splitlines())
+    if refs.get("refs/remotes/origin/HEAD"):
+        return refs["refs/remotes/origin/HEAD"].removeprefix("refs/remotes/origin/")
+    for name in ("main", "master"):
+        if f"refs/heads/{name}" in refs:
+            return name
+    return "main"
+
+
+def get_merge_base(base: str, head: str) -> str | None:
     result = git("merge-base", base, head)
     if result.returncode != 0:
         return None
     return result.stdout.strip()
 
 
-def parse_diff_stats(diff_text: str) -> tuple[int, int, int]:
-    """Parse diff text to count files, additions, deletions."""
-    files = 0
-    additions = 0
-    deletions = 0
-    for line in diff_text.splitlines():
-        if line.startswith("diff --git"):
-            files += 1
-        elif line.startswith("+") and not line.startswith("+++"):
-            additions += 1
-        elif line.startswith("-") and not line.startswith("---"):
-            deletions += 1
-    return files, additions, deletions
-
-
-@app.command()
-def main(
-    base: Annotated[
-        Optional[str],
-        typer.Argument(help="Base ref to diff against (default: auto-detected)."),
-    ] = None,
-    head: Annotated[
-        str,
-        typer.Argument(help="Head ref (default: HEAD)."),
-    ] = "HEAD",
-    output: Annotated[
-        Optional[Path],
-        typer.Option("--output", "-o", help="Save HTML to this path instead of a temp file."),
-    ] = None,
-    no_open: Annotated[
-        bool,
-        typer.Option("--no-open", help="Print the file path without opening the browser."),
-    ] = False,
+# Plain classes rather than dataclasses: importing dataclasses pulls in
+# inspect, which would roughly double ajdiff's import time.
+class Hunk:
+    """One ``@@`` hunk of a file diff."""
+
+    __slots__ = ("header", "old_start", "old_count", "new_start", "new_count", "lines")
+
+    def __init__(self, header: str, old_start: int, old_count: int, new_start: int, new_count: int) -> None:
+        self.header = header
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        self.lines: list[str] = []
+
+
+class FileDiff:
+    """One ``diff --git`` section: the header lines plus its hunks."""
+
+    __slots__ = (
+        "old_path", "new_path", "status", "header", "hunks", "binary",
+        "old_sha", "new_sha", "strategy", "summarized", "submodule",
+    )
+
+    def __init__(self, old_path: str, new_path: str, header: list[str]) -> None:
+        self.old_path = old_path
+        self.new_path = new_path
+        self.status = "M"
+        self.header = header
+        self.hunks: list[Hunk] = []
+        self.binary = False
+        # Blob ids from the "index" line; full-length when diffed with --full-index.
+        self.old_sha = ""
+        self.new_sha = ""
+        # Set when the file was diffed differently from the rest (see collect_diff).
+        self.strategy: str | None = None
+        self.summarized = False
+        # Submodule the file belongs to (see collect_diff_with_submodules).
+        self.submodule: str | None = None
+
+    @property
+    def path(self) -> str:
+        return self.old_path if self.status == "D" else self.new_path
+
+    @property
+    def text(self) -> str:
+        """The file's patch, exactly as git printed it."""
+        out = list(self.header)
+        for hunk in self.hunks:
+            out.append(hunk.header)
+            out.extend(hunk.lines)
+        return "\n".join(out) + "\n"
+
+
+HUNK_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+def unquote_path(path: str) -> str:
+    """Undo git's C-style quoting of paths containing unusual characters."""
+    path = path.rstrip("\t")
+    if not (path.startswith('"') and path.endswith('"')):
+        return path
+    import codecs
+
+    raw = codecs.escape_decode(path[1:-1].encode())[0]
+    return raw.decode("utf-8", errors="replace")
+
+
+def strip_prefix(path: str) -> str:
+    """Drop git's ``a/`` or ``b/`` prefix from a header path."""
+    path = unquote_path(path)
+    return path[2:] if path[:2] in ("a/", "b/") else path
+
+
+def iter_file_diffs(lines: Iterable[str]) -> Iterator[FileDiff]:
+    """Parse ``git diff`` output into FileDiffs, yielding each file as soon as it ends.
+
+    Accepts any iterable of lines (with or without trailing newlines), so it
+    can consume a ``git diff`` pipe incrementally.
+    """
+    current: FileDiff | None = None
+    hunk: Hunk | None = None
+    for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith("diff --git "):
+            if current is not None:
+                yield current
+            # Provisional paths; refined by the ---/+++ or rename lines below.
+            rest = line[len("diff --git "):]
+            half = len(rest) // 2
+            old = strip_prefix(rest[:half]) if rest[half] == " " else strip_prefix(rest.split(" ", 1)[0])
+            new = strip_prefix(rest[half + 1:]) if rest[half] == " " else strip_prefix(rest.rsplit(" ", 1)[-1])
+            current = FileDiff(old_path=old, new_path=new, header=[line])
+            hunk = None
+            continue
+        if current is None:
+            continue
+        if hunk is not None and line[:1] in (" ", "+", "-", "\\", ""):
+            hunk.lines.append(line)
+            continue
+        m = HUNK_RE.match(line)
+        if m:
+            hunk = Hunk(
+                header=line,
+                old_start=int(m.group(1)),
+                old_count=int(m.group(2) or 1),
+                new_start=int(m.group(3)),
+                new_count=int(m.group(4) or 1),
+            )
+            current.hunks.append(hunk)
+            continue
+        current.header.append(line)
+        if line.startswith("new file mode"):
+            current.status = "A"
+        elif line.startswith("deleted file mode"):
+            current.status = "D"
+        elif line.startswith("rename from "):
+            current.status = "R"
+            current.old_path = unquote_path(line[len("rename from "):])
+        elif line.startswith("rename to "):
+            current.new_path = unquote_path(line[len("rename to "):])
+        elif line.startswith("copy from "):
+            current.status = "C"
+            current.old_path = unquote_path(line[len("copy from "):])
+        elif line.startswith("copy to "):
+            current.new_path = unquote_path(line[len("copy to "):])
+        elif line.startswith("--- ") and line != "--- /dev/null":
+            current.old_path = strip_prefix(line[4:])
+        elif line.startswith("+++ ") and line != "+++ /dev/null":
+            current.new_path = strip_prefix(line[4:])
+        elif line.startswith("index "):
+            current.old_sha, _, rest = line[len("index "):].partition("..")
+            current.new_sha = rest.split(" ", 1)[0]
+        elif line.startswith("Binary files ") or line == "GIT binary patch":
+            current.binary = True
+    if current is not None:
+        yield current
+
+
+# Intraline (word-level) highlights are computed here rather than by
+# diff2html's client-side line matching, which is quadratic in block size.
+# Blocks, lines and time spent are all capped so a huge rewrite degrades to
+# plain line highlighting instead of stalling.
+INTRALINE_MAX_BLOCK_LINES = 200
+INTRALINE_MAX_LINE_LENGTH = 1000
+INTRALINE_MIN_SIMILARITY = 0.5
+INTRALINE_HUNK_BUDGET = 0.05  # seconds
+INTRALINE_TOTAL_BUDGET = 1.0  # seconds
+
+WORD_RE = re.compile(r"\w+|\s+|[^\w\s]")
+
+
+def utf16_len(text: str) -> int:
+    """Length of ``text`` in UTF-16 code units, the way JS strings count it."""
+    return len(text) if text.isascii() else len(text.encode("utf-16-le")) // 2
+
+
+def word_ranges(old: str, new: str) -> tuple[list[list[int]], list[list[int]]] | None:
+    """Ranges ``[start, end)`` that differ between two lines, by word.
+
+    Offsets are in UTF-16 code units, since the page applies them to JS
+    strings; a character outside the BMP (most emoji) counts as two.
+    Returns None when the lines are too dissimilar for word highlights to help.
+    """
+    from difflib import SequenceMatcher
+
+    a = WORD_RE.findall(old)
+    b = WORD_RE.findall(new)
+    matcher = SequenceMatcher(None, a, b, autojunk=False)
+    if matcher.ratio() < INTRALINE_MIN_SIMILARITY:
+        return None
+    a_pos = [0]
+    for tok in a:
+        a_pos.append(a_pos[-1] + utf16_len(tok))
+    b_pos = [0]
+    for tok in b:
+        b_pos.append(b_pos[-1] + utf16_len(tok))
+
+    old_ranges: list[list[int]] = []
+    new_ranges: list[list[int]] = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        if i1 < i2:
+            old_ranges.append([a_pos[i1], a_pos[i2]])
+        if j1 < j2:
+            new_ranges.append([b_pos[j1], b_pos[j2]])
+    return old_ranges, new_ranges
+
+
+def intraline_changes(file: FileDiff, deadline: float) -> dict[str, dict[int, list[list[int]]]] | None:
+    """Word-level change ranges for a file, keyed by side and line number.
+
+    Deleted lines are keyed by old line number under ``"del"``, added lines
+    by new line number under ``"ins"``. Within each run of ``-`` lines
+    followed by ``+`` lines, lines are paired positionally. Returns None if
+    no line in the file got word highlights.
+    """
+    result: dict[str, dict[int, list[list[int]]]] = {"del": {}, "ins": {}}
+    for hunk in file.hunks:
+        if time.perf_counter() > deadline:
+            break
+        hunk_deadline = min(deadline, time.perf_counter() + INTRALINE_HUNK_BUDGET)
+        old_no, new_no = hunk.old_start, hunk.new_start
+        dels: list[tuple[int, str]] = []
+        adds: list[tuple[int, str]] = []
+
+        def flush() -> None:
+            if dels and adds and len(dels) + len(adds) <= INTRALINE_MAX_BLOCK_LINES:
+                for (o, old), (n, new) in zip(dels, adds):
+                    if time.perf_counter() > hunk_deadline:
+                        break
+                    if max(len(old), len(new)) > INTRALINE_MAX_LINE_LENGTH:
+                        continue
+                    ranges = word_ranges(old, new)
+                    if ranges is None:
+                        continue
+                    if ranges[0]:
+                        result["del"][o] = ranges[0]
+                    if ranges[1]:
+                        result["ins"][n] = ranges[1]
+            dels.clear()
+            adds.clear()
+
+        for line in hunk.lines:
+            tag = line[:1]
+            if tag == "-":
+                if adds:
+                    flush()
+                dels.append((old_no, line[1:]))
+                old_no += 1
+            elif tag == "+":
+                adds.append((new_no, line[1:]))
+                new_no += 1
+            elif tag == "\\":
+                continue
+            else:
+                flush()
+                old_no += 1
+                new_no += 1
+        flush()
+    return result if result["del"] or result["ins"] else None
+
+
+# Diff computation. Files whose blobs exceed the size budget are left out of
+# the main `git diff` and diffed one at a time. That is git's default myers
+# algorithm (any --diff-algorithm is dropped) under a timeout, not a cheaper
+# kind of diff: what it buys is that a single generated dump can't stall the
+# whole report. If it times out, or its patch is over MAX_PATCH_SIZE, the
+# file is summarized.
+DIFF_ALGORITHMS = ("myers", "minimal", "patience", "histogram")
+DEFAULT_MAX_FILE_SIZE = 1 << 20
+DEFAULT_FILE_TIMEOUT = 5.0
+# A patch the page couldn't usefully draw, whatever the blobs' sizes.
+MAX_PATCH_SIZE = 8 << 20
+NULL_SHA = "0" * 40
+# Report rename detection time above this, and suggest cheaper modes above the hint threshold.
+RENAME_REPORT_SECONDS = 0.1
+RENAME_HINT_SECONDS = 1.0
+
+
+class RawEntry(namedtuple("RawEntry", "status old_mode new_mode old_sha new_sha old_path new_path")):
+    """One entry of ``git diff --raw -z`` output."""
+
+    __slots__ = ()
+
+    @property
+    def path(self) -> str:
+        return self.old_path if self.status == "D" else self.new_path
+
+
+def parse_raw(text: str) -> list[RawEntry]:
+    """Parse ``git diff --raw -z --no-abbrev`` output."""
+    entries = []
+    fields = text.split("\0")
+    i = 0
+    while i < len(fields) and fields[i].startswith(":"):
+        old_mode, new_mode, old_sha, new_sha, status = fields[i][1:].split(" ")
+        status = status[:1]
+        old_path = fields[i + 1]
+        if status in ("R", "C"):
+            new_path = fields[i + 2]
+            i += 3
+        else:
+            new_path = old_path
+            i += 2
+        entries.append(RawEntry(status, old_mode, new_mode, old_sha, new_sha, old_path, new_path))
+    return entries
+
+
+def blob_sizes(shas: Iterable[str]) -> dict[str, int]:
+    """Sizes of the given blobs, from one ``git cat-file --batch-check`` call."""
+    wanted = sorted({s for s in shas if s != NULL_SHA})
+    if not wanted:
+        return {}
+    result = git("cat-file", "--batch-check=%(objectname) %(objecttype) %(objectsize)", input="\n".join(wanted) + "\n")
+    sizes = {}
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[1] == "blob":
+            sizes[parts[0]] = int(parts[2])
+    return sizes
+
+
+def format_size(n: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+
+def parse_size(text: str) -> int:
+    """Parse a byte count such as ``500000``, ``512k`` or ``2M``."""
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+    text = text.strip().lower().removesuffix("b")
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        import argparse
+
+        raise argparse.ArgumentTypeError(f"invalid size: {text!r}") from None
+
+
+def literal(path: str, exclude: bool = False) -> str:
+    """Pathspec matching exactly ``path`` (relative to the repo root)."""
+    return f":(top,literal{',exclude' if exclude else ''}){path}"
+
+
+def summarized(entry: RawEntry, reason: str) -> FileDiff:
+    """A header-only FileDiff standing in for a file whose diff was skipped."""
+    old = "/dev/null" if entry.status == "A" else f"a/{entry.old_path}"
+    new = "/dev/null" if entry.status == "D" else f"b/{entry.new_path}"
+    header = [f"diff --git a/{entry.old_path} b/{entry.new_path}"]
+    if entry.status == "A":
+        header.append(f"new file mode {entry.new_mode}")
+    elif entry.status == "D":
+        header.append(f"deleted file mode {entry.old_mode}")
+    header += [f"index {entry.old_sha}..{entry.new_sha}", f"--- {old}", f"+++ {new}"]
+    file = FileDiff(entry.old_path, entry.new_path, header)
+    file.status = entry.status
+    file.old_sha, file.new_sha = entry.old_sha, entry.new_sha
+    file.strategy = f"summarized: {reason}"
+    file.summarized = True
+    return file
+
+
+def diff_large_file(
+    entry: RawEntry,
+    rev_range: str,
+    flags: list[str],
+    size: int,
+    max_file_size: int,
+    timeout: float,
+) -> FileDiff:
+    """Diff one over-budget file on its own with myers and a timeout, summarizing it if that fails."""
+    flags = [f for f in flags if not f.startswith("--diff-algorithm")]
+    paths = [literal(entry.old_path)] if entry.old_path == entry.new_path else [literal(entry.old_path), literal(entry.new_path)]
+    start = time.perf_counter()
+    try:
+        result = git("diff", *flags, "--diff-algorithm=myers", rev_range, "--", *paths, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return summarized(entry, f"{format_size(size)}, diff timed out after {timeout:g}s")
+    if len(result.stdout) > MAX_PATCH_SIZE:
+        return summarized(
+            entry, f"{format_size(size)}, patch is {format_size(len(result.stdout))} "
+            f"(over the {format_size(MAX_PATCH_SIZE)} patch limit)",
+        )
+    files = list(iter_file_diffs(result.stdout.removesuffix("\n").split("\n")))
+    if not files:
+        return summarized(entry, f"{format_size(size)}, no textual diff")
+    file = files[0]
+    elapsed = time.perf_counter() - start
+    file.strategy = (
+        f"diffed alone with myers and a {timeout:g}s timeout: {format_size(size)} "
+        f"over the {format_size(max_file_size)} budget ({elapsed:.1f}s)"
+    )
+    return file
+
+
+def git_checked(*args: str, env: dict[str, str] | None = None) -> subprocess.CompletedProcess[str]:
+    """Run a git command, raising ``subprocess.CalledProcessError`` on failure."""
+    result = git(*args, env=env)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+    return result
+
+
+def scratch_file(prefix: str, suffix: str = "") -> str:
+    """Create an empty file only we can read in the temp dir and return its path.
+
+    Like ``tempfile.mkstemp``, without importing tempfile (and with it shutil,
+    random and weakref) on every run.
+    """
+    tmp = os.environ.get("TMPDIR") or "/tmp"
+    path = os.path.join(tmp, f"{prefix}{os.getpid()}-{os.urandom(6).hex()}{suffix}")
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+    return path
+
+
+# What git prints when a diff has more rename candidates than the rename
+# limit allows: it then skips inexact detection and leaves adds and deletes.
+RENAME_LIMIT_RE = re.compile(r"diff\.renameLimit variable to at least (\d+)")
+
+
+def git_timed_renames(*args: str, timings: dict[str, float]) -> subprocess.CompletedProcess[str]:
+    """Run a git diff command, recording the seconds git spent in rename detection.
+
+    The time comes from git's own trace2 regions in diffcore-rename.c, so it
+    excludes tree walking and patch generation. It goes in ``timings`` under
+    ``"rename_detection"``. If git skipped detection because of its rename
+    limit, the limit it asked for goes under ``"rename_limit"``.
+    """
+    import json
+
+    trace_path = scratch_file("ajdiff-trace2-")
+    try:
+        result = git_checked(*args, env={"GIT_TRACE2_EVENT": trace_path})
+        seconds = 0.0
+        with open(trace_path, errors="replace") as f:
+            for line in f:
+                if '"region_leave"' not in line or "diffcore-rename.c" not in line:
+                    continue
+                event = json.loads(line)
+                if event.get("nesting") == 1:
+                    seconds += event.get("t_rel", 0.0)
+    finally:
+        os.unlink(trace_path)
+    timings["rename_detection"] = seconds
+    if match := RENAME_LIMIT_RE.search(result.stderr):
+        timings["rename_limit"] = int(match.group(1))
+    return result
+
+
+def detect_renames(
+    files: list[FileDiff],
+    rev_range: str,
+    flags: list[str],
+    rename_flags: list[str],
+    timings: dict[str, float],
+) -> list[FileDiff]:
+    """Pair up added and deleted files from a ``--no-renames`` diff as renames/copies.
+
+    Only the added/deleted files already in ``files`` are considered, and
+    only the pairs found are re-diffed.
+    """
+    added = [f.new_path for f in files if f.status == "A" and not f.summarized]
+    deleted = [f.old_path for f in files if f.status == "D" and not f.summarized]
+    if not added or not deleted:
+        return files
+    raw = git_timed_renames(
+        "diff", "--raw", "-z", "--no-abbrev", *(rename_flags or ["-M"]), rev_range,
+        "--", *(literal(p) for p in added + deleted), timings=timings,
+    )
+    pairs = [e for e in parse_raw(raw.stdout) if e.status in ("R", "C")]
+    if not pairs:
+        return files
+    result = git_checked(
+        "diff", *flags, *(rename_flags or ["-M"]), rev_range,
+        "--", *{literal(p): None for e in pairs for p in (e.old_path, e.new_path)},
+    )
+    paired = [f for f in iter_file_diffs(result.stdout.removesuffix("\n").split("\n")) if f.status in ("R", "C")]
+    gone = {("A", f.new_path) for f in paired} | {("D", f.old_path) for f in paired if f.status == "R"}
+    import heapq
+
+    kept = [f for f in files if (f.status, f.path) not in gone]
+    return list(heapq.merge(kept, sorted(paired, key=lambda f: f.path), key=lambda f: f.path))
+
+
+def list_changes(rev_range: str, scope: list[str]) -> list[RawEntry]:
+    """The changed files, as ``--raw`` entries without rename detection."""
+    # Without rename detection --raw never reads blob contents.
+    raw = git_checked("diff", "--raw", "-z", "--no-abbrev", "--no-renames", rev_range, "--", *scope)
+    return parse_raw(raw.stdout)
+
+
+def find_oversized(
+    rev_range: str,
+    scope: list[str],
+    max_file_size: int,
+    entries: list[RawEntry] | None = None,
+    sizes: dict[str, int] | None = None,
+) -> list[tuple[RawEntry, int]]:
+    """Changed files with a blob over ``max_file_size``, with that size (none if 0).
+
+    ``entries`` and ``sizes`` are the diff's ``list_changes`` and their blob
+    sizes, if the caller already has them.
+    """
+    if not max_file_size:
+        return []
+    if entries is None:
+        entries = list_changes(rev_range, scope)
+    if sizes is None:
+        sizes = blob_sizes(s for e in entries for s in (e.old_sha, e.new_sha))
+    oversized = []
+    for e in entries:
+        size = max(sizes.get(e.old_sha, 0), sizes.get(e.new_sha, 0))
+        if size > max_file_size:
+            oversized.append((e, size))
+    return oversized
+
+
+def collect_diff(
+    base: str,
+    head: str,
+    flags: list[str],
+    rename_flags: list[str] | None = None,
+    max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+    file_timeout: float = DEFAULT_FILE_TIMEOUT,
+    deferred_renames: bool = False,
+    timings: dict[str, float] | None = None,
+    pathspec: list[str] | None = None,
+    entries: list[RawEntry] | None = None,
+    sizes: dict[str, int] | None = None,
+) -> list[FileDiff]:
+    """Diff ``base...head`` into FileDiffs, applying the per-file size/time budget.
+
+    ``flags`` are extra ``git diff`` options (e.g. the algorithm) and
+    ``rename_flags`` the rename/copy detection options. ``pathspec``
+    restricts every git call to part of the tree (see ``build_pathspec``). With
+    ``deferred_renames`` the main diff runs with ``--no-renames`` and
+    renames are then detected only among the added/deleted files it
+    produced. A ``max_file_size`` of 0 disables the size budget. ``entries``
+    and ``sizes`` skip listing the diff for the budget (see ``find_oversized``).
+
+    Time spent in git's rename detection is recorded in ``timings`` (see
+    ``git_timed_renames``).
+
+    Raises ``subprocess.CalledProcessError`` if git fails.
+    """
+    rev_range = f"{base}...{head}"
+    rename_flags = rename_flags or []
+    timings = {} if timings is None else timings
+    scope = pathspec or [":/"]
+    common = ["--no-color", "--no-ext-diff", "--full-index", *flags]
+    main_flags = [*common, "--no-renames"] if deferred_renames else [*common, *rename_flags]
+
+    oversized = find_oversized(rev_range, scope, max_file_size, entries, sizes)
+    excludes = [literal(e.path, exclude=True) for e, _ in oversized]
+    result = git_timed_renames("diff", *main_flags, rev_range, "--", *scope, *excludes, timings=timings)
+    files = list(iter_file_diffs(result.stdout.removesuffix("\n").split("\n")))
+
+    if oversized:
+        import heapq
+
+        large = sorted(
+            (diff_large_file(e, rev_range, main_flags, size, max_file_size, file_timeout) for e, size in oversized),
+            key=lambda f: f.path,
+        )
+        # Slot the large files back in by path so the page keeps git's order.
+        files = list(heapq.merge(files, large, key=lambda f: f.path))
+    if deferred_renames:
+        files = detect_renames(files, rev_range, common, rename_flags, timings)
+    return files
+
+
+def iter_diff(
+    base: str,
+    head: str,
+    flags: list[str],
+    rename_flags: list[str] | None = None,
+    max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+    file_timeout: float = DEFAULT_FILE_TIMEOUT,
+    pathspec: list[str] | None = None,
+) -> Iterator[FileDiff]:
+    """Like ``collect_diff``, but yield each file as soon as git has printed it.
+
+    Rename timings and deferred renames need the whole diff, so they aren't
+    supported here.
+
+    Raises ``subprocess.CalledProcessError`` if git fails.
+    """
+    import heapq
+
+    rev_range = f"{base}...{head}"
+    scope = pathspec or [":/"]
+    main_flags = ["--no-color", "--no-ext-diff", "--full-index", *flags, *(rename_flags or [])]
+    oversized = sorted(find_oversized(rev_range, scope, max_file_size), key=lambda o: o[0].path)
+    excludes = [literal(e.path, exclude=True) for e, _ in oversized]
+    cmd = ["git", "diff", *main_flags, rev_range, "--", *scope, *excludes]
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+        # Decode per line rather than use text mode, which would also split at "\r".
+        lines = (line.decode(errors="replace") for line in proc.stdout)
+        large = (diff_large_file(e, rev_range, main_flags, size, max_file_size, file_timeout) for e, size in oversized)
+        yield from heapq.merge(iter_file_diffs(lines), large, key=lambda f: f.path)
+        stderr = proc.stderr.read()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, None, stderr.decode(errors="replace"))
+
+
+# Below this many changed files, or this many bytes of changed blobs, one
+# git diff beats starting a process pool: each shard pays for its own
+# process, git startup and tree walk. Conservative, since the speedup has
+# only been measured on few cores (see bench.py parallel).
+PARALLEL_MIN_FILES = 200
+PARALLEL_MIN_BYTES = 16 << 20
+# Keeps each shard's pathspec well inside the command-line length limit.
+SHARD_MAX_PATHS = 2000
+
+
+def diff_shards(
+    entries: list[RawEntry], sizes: dict[str, int], count: int, renames: bool = True,
+) -> list[list[RawEntry]]:
+    """Split ``list_changes`` entries into at least ``count`` shards of similar total size.
+
+    No shard gets more than ``SHARD_MAX_PATHS`` files. With ``renames``,
+    files git could pair as a rename stay together: a lone deleted and added
+    file with the same blob (an exact rename), and all other added and
+    deleted files, which are the pool git searches for inexact renames. A
+    single shard back means the diff can't be split usefully.
+    """
+    import heapq
+
+    exact: set[str] = set()
+    if renames:
+        counts: dict[tuple[str, str], int] = {}
+        for e in entries:
+            if e.status in ("A", "D"):
+                key = (e.status, e.new_sha if e.status == "A" else e.old_sha)
+                counts[key] = counts.get(key, 0) + 1
+        exact = {sha for (status, sha), n in counts.items() if status == "D" and n == 1 and counts.get(("A", sha)) == 1}
+    groups: dict[str, list[RawEntry]] = {}
+    weights: dict[str, int] = {}
+    for e in entries:
+        if not renames or e.status not in ("A", "D"):
+            key = "path:" + e.path
+        else:
+            sha = e.new_sha if e.status == "A" else e.old_sha
+            key = "sha:" + sha if sha in exact else "renames"
+        groups.setdefault(key, []).append(e)
+        # Blob bytes approximate diff time; the constant covers per-file overhead.
+        weights[key] = weights.get(key, 0) + sizes.get(e.old_sha, 0) + sizes.get(e.new_sha, 0) + 4096
+    if any(len(group) > SHARD_MAX_PATHS for group in groups.values()):
+        return [entries]
+
+    # Largest group first onto the least loaded shard with room for it.
+    shards: list[list[RawEntry]] = [[] for _ in range(count)]
+    loads = [(0, k) for k in range(count)]
+    for key in sorted(groups, key=lambda k: (-weights[k], k)):
+        group = groups[key]
+        full = []
+        while loads and len(shards[loads[0][1]]) + len(group) > SHARD_MAX_PATHS:
+            full.append(heapq.heappop(loads))
+        if loads:
+            load, k = heapq.heappop(loads)
+        else:
+            load, k = 0, len(shards)
+            shards.append([])
+        shards[k].extend(group)
+        heapq.heappush(loads, (load + weights[key], k))
+        for item in full:
+            heapq.heappush(loads, item)
+    return [shard for shard in shards if shard]
+
+
+def diff_shard(
+    base: str,
+    head: str,
+    flags: list[str],
+    rename_flags: list[str] | None,
+    max_file_size: int,
+    file_timeout: float,
+    entries: list[RawEntry],
+    sizes: dict[str, int],
+) -> tuple[list[FileDiff], dict[str, float]]:
+    """``collect_diff`` of one ``diff_shards`` shard, and its ``timings``."""
+    timings: dict[str, float] = {}
+    files = collect_diff(
+        base, head, flags, rename_flags, max_file_size, file_timeout, timings=timings,
+        pathspec=[literal(path) for path in sorted({e.path for e in entries})], entries=entries, sizes=sizes,
+    )
+    return files, timings
+
+
+def collect_diff_parallel(
+    base: str,
+    head: str,
+    flags: list[str],
+    rename_flags: list[str] | None,
+    jobs: int,
+    max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+    file_timeout: float = DEFAULT_FILE_TIMEOUT,
+    timings: dict[str, float] | None = None,
+    pathspec: list[str] | None = None,
+) -> list[FileDiff]:
+    """``collect_diff`` spread over ``jobs`` worker processes.
+
+    The changed files are listed once without rename detection, and that
+    listing and its blob sizes serve both the size budget and
+    ``diff_shards``. Each shard gets its own ``git diff`` limited to its
+    paths, and the results are merged back into git's path order, so the
+    output matches a single run. Small diffs (see ``PARALLEL_MIN_FILES``
+    and ``PARALLEL_MIN_BYTES``), ``jobs`` of 1 and copy detection (any file
+    may be a copy's source) go straight to ``collect_diff``.
+
+    Raises ``subprocess.CalledProcessError`` if git fails.
+    """
+    rev_range = f"{base}...{head}"
+    timings = {} if timings is None else timings
+    rename_flags = rename_flags or []
+    entries = list_changes(rev_range, pathspec or [":/"])
+    options = dict(max_file_size=max_file_size, file_timeout=file_timeout, timings=timings, pathspec=pathspec)
+    if jobs <= 1 or len(entries) < PARALLEL_MIN_FILES:
+        return collect_diff(base, head, flags, rename_flags, entries=entries, **options)
+    sizes = blob_sizes(s for e in entries for s in (e.old_sha, e.new_sha))
+    if sum(max(sizes.get(e.old_sha, 0), sizes.get(e.new_sha, 0)) for e in entries) < PARALLEL_MIN_BYTES:
+        return collect_diff(base, head, flags, rename_flags, entries=entries, sizes=sizes, **options)
+
+    import heapq
+    from concurrent.futures import ProcessPoolExecutor
+
+    renames = "--no-renames" not in rename_flags
+    copies = renames and (
+        any(f.startswith("-C") for f in rename_flags)
+        or git("config", "--get", "diff.renames").stdout.strip().lower().startswith("cop")
+    )
+    shards = [] if copies else diff_shards(entries, sizes, max(jobs, -(-len(entries) // SHARD_MAX_PATHS)), renames)
+    if len(shards) <= 1:
+        return collect_diff(base, head, flags, rename_flags, entries=entries, sizes=sizes, **options)
+    with ProcessPoolExecutor(max_workers=min(jobs, len(shards))) as pool:
+        futures = [
+            pool.submit(
+                diff_shard, base, head, flags, rename_flags, max_file_size, file_timeout, shard,
+                {sha: sizes[sha] for e in shard for sha in (e.old_sha, e.new_sha) if sha in sizes},
+            )
+            for shard in shards
+        ]
+        results = [f.result() for f in futures]
+    # The shards ran side by side, so the slowest one is what it cost.
+    timings["rename_detection"] = max(t["rename_detection"] for _, t in results)
+    if limits := [t["rename_limit"] for _, t in results if "rename_limit" in t]:
+        timings["rename_limit"] = max(limits)
+    return list(heapq.merge(*(files for files, _ in results), key=lambda f: f.path))
+
+
+GITLINK_MODE = "160000"
+
+
+def prefix_paths(file: FileDiff, prefix: str) -> FileDiff:
+    """Move a file diffed inside a submodule under the submodule's ``prefix``.
+
+    git already prefixed the ``diff --git`` and ``---``/``+++`` lines (see
+    ``submodule_diff``); this does the rest and re-reads the paths.
+    """
+    header = []
+    for line in file.header:
+        if file.summarized:  # built by summarized(), not by git
+            if line.startswith("diff --git "):
+                line = f"diff --git a/{prefix}{file.old_path} b/{prefix}{file.new_path}"
+            elif line.startswith(("--- a/", "+++ b/")):
+                line = line[:6] + prefix + line[6:]
+        for key in ("rename from ", "rename to ", "copy from ", "copy to "):
+            if line.startswith(key):
+                value = line[len(key):]
+                quote = '"' if value.startswith('"') else ""
+                line = key + quote + prefix + value[len(quote):]
+        header.append(line)
+    parsed = next(iter_file_diffs(header))
+    file.header = header
+    file.old_path, file.new_path = parsed.old_path, parsed.new_path
+    file.submodule = prefix.rstrip("/")
+    return file
+
+
+def submodule_diff(
+    root: str,
+    path: str,
+    old: str,
+    new: str,
+    flags: list[str],
+    rename_flags: list[str],
+    max_file_size: int,
+    file_timeout: float,
+) -> list[FileDiff]:
+    """Diff submodule ``path`` (checked out under ``root``) from commit ``old`` to ``new``.
+
+    Runs in a worker process. Paths come back under ``path/``.
+    """
+    os.chdir(os.path.join(root, path))
+    prefix = path + "/"
+    flags = [*flags, f"--src-prefix=a/{prefix}", f"--dst-prefix=b/{prefix}"]
+    files = collect_diff(old, new, flags, rename_flags, max_file_size=max_file_size, file_timeout=file_timeout)
+    return [prefix_paths(f, prefix) for f in files]
+
+
+def collect_diff_with_submodules(
+    base: str,
+    head: str,
+    flags: list[str],
+    rename_flags: list[str],
+    jobs: int,
+    max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+    file_timeout: float = DEFAULT_FILE_TIMEOUT,
+    deferred_renames: bool = False,
+    timings: dict[str, float] | None = None,
+    pathspec: list[str] | None = None,
+) -> list[FileDiff]:
+    """``collect_diff``, with each changed submodule replaced by its own diff.
+
+    The submodules' old and new commits come from a ``--raw`` pass over the
+    superproject. They are diffed ``jobs`` at a time in worker processes
+    while the superproject diff runs, so the total is roughly the slowest of
+    them. A submodule that isn't checked out, or lacks either commit, keeps
+    its ``Subproject commit`` entry with a strategy note. Nested submodules
+    are not descended into, and pathspecs only apply to the superproject.
+    """
+    rev_range = f"{base}...{head}"
+    raw = git_checked("diff", "--raw", "-z", "--no-abbrev", "--no-renames", rev_range, "--", *(pathspec or [":/"]))
+    links = [e for e in parse_raw(raw.stdout) if e.old_mode == GITLINK_MODE and e.new_mode == GITLINK_MODE]
+    root = git_checked("rev-parse", "--show-toplevel").stdout.strip()
+    ready = [e for e in links if os.path.exists(os.path.join(root, e.path, ".git"))]
+    notes = {e.path: "submodule not checked out" for e in links if e not in ready}
+
+    pool = None
+    pending = {}
+    if ready:
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(max_workers=min(jobs, len(ready)))
+        for e in ready:
+            pending[e.path] = pool.submit(
+                submodule_diff, root, e.path, e.old_sha, e.new_sha,
+                flags, rename_flags, max_file_size, file_timeout,
+            )
+    try:
+        files = collect_diff(
+            base, head, flags, rename_flags,
+            max_file_size=max_file_size, file_timeout=file_timeout,
+            deferred_renames=deferred_renames, timings=timings, pathspec=pathspec,
+        )
+        merged = []
+        for f in files:
+            if f.path in pending:
+                try:
+                    inner = pending[f.path].result()
+                except subprocess.CalledProcessError as e:
+                    notes[f.path] = f"submodule diff failed: {(e.stderr or '').strip()}"
+                else:
+                    if inner:
+                        merged.extend(inner)
+                        continue
+            f.strategy = notes.get(f.path, f.strategy)
+            merged.append(f)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return merged
+
+
+# Each run records the head it showed in <common git dir>/ajdiff/reviews.json,
+# per "base...branch". --interdiff compares against the last recorded head
+# that differs from the current one.
+MAX_REVIEWS = 20
+INTERDIFF_CACHE_ENTRIES = 50
+INTERDIFF_MAX_PATHSPEC = 1000
+
+
+def load_reviews(state_dir: Path) -> dict[str, list[dict[str, object]]]:
+    import json
+
+    try:
+        return json.loads((state_dir / "reviews.json").read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def record_review(state_dir: Path, key: str, head_sha: str, base_sha: str) -> None:
+    """Remember that ``key`` was reviewed at ``head_sha`` (on top of ``base_sha``)."""
+    import json
+
+    reviews = load_reviews(state_dir)
+    history = reviews.setdefault(key, [])
+    if history and history[-1]["head"] == head_sha:
+        return
+    history.append({"head": head_sha, "base": base_sha, "time": int(time.time())})
+    del history[:-MAX_REVIEWS]
+    state_dir.mkdir(parents=True, exist_ok=True)
+    tmp = state_dir / "reviews.json.tmp"
+    tmp.write_text(json.dumps(reviews, indent=1))
+    tmp.replace(state_dir / "reviews.json")
+
+
+def interdiff(
+    old: tuple[str, str],
+    new: tuple[str, str],
+    flags: list[str],
+    rename_flags: list[str] | None = None,
+    pathspec: list[str] | None = None,
+    cache_dir: Path | None = None,
+) -> list[FileDiff]:
+    """What changed in a branch between two reviewed versions, file by file.
+
+    ``old`` and ``new`` are ``(merge base, head)`` commit ids. As with
+    ``git range-diff``, a file whose patch is the same in both versions (same
+    blob pair) is left out even if the branch was rebased; the others are
+    diffed from the old head to the new head. If a file's base version moved
+    too, its interdiff includes those upstream changes, and it gets a
+    strategy note saying so.
+
+    Results are cached in ``cache_dir`` by commit ids and options. Raises
+    ``subprocess.CalledProcessError`` if git fails.
+    """
+    import hashlib
+    import json
+
+    scope = pathspec or [":/"]
+    options = ["--no-color", "--no-ext-diff", "--full-index", *flags, *(rename_flags or [])]
+    cache_file = None
+    if cache_dir is not None:
+        digest = hashlib.sha1(json.dumps([old, new, options, scope]).encode()).hexdigest()
+        cache_file = cache_dir / f"{old[1][:12]}-{new[1][:12]}-{digest[:12]}.json"
+        try:
+            cached = json.loads(cache_file.read_text())
+        except (OSError, ValueError):
+            pass
+        else:
+            files = list(iter_file_diffs(cached["patch"].removesuffix("\n").split("\n"))) if cached["patch"] else []
+            for f in files:
+                f.strategy = cached["notes"].get(f.path)
+            return files
+
+    def entries(base: str, head: str) -> dict[str, RawEntry]:
+        raw = git_checked("diff", "--raw", "-z", "--no-abbrev", "--no-renames", base, head, "--", *scope)
+        return {e.path: e for e in parse_raw(raw.stdout)}
+
+    before, after = entries(*old), entries(*new)
+    changed: set[str] = set()
+    notes: dict[str, str] = {}
+    for path in before.keys() | after.keys():
+        b, a = before.get(path), after.get(path)
+        if b and a and (b.old_sha, b.new_sha, b.new_mode) == (a.old_sha, a.new_sha, a.new_mode):
+            continue
+        changed.add(path)
+        if b and a and b.old_sha != a.old_sha:
+            notes[path] = "interdiff: the base version changed too, so upstream changes are included"
+
+    files: list[FileDiff] = []
+    if changed:
+        # Past a point, diffing everything and filtering beats a huge command line.
+        paths = [literal(p) for p in sorted(changed)] if len(changed) <= INTERDIFF_MAX_PATHSPEC else scope
+        result = git_checked("diff", *options, old[1], new[1], "--", *paths)
+        for f in iter_file_diffs(result.stdout.removesuffix("\n").split("\n")):
+            if f.old_path in changed or f.new_path in changed:
+                f.strategy = notes.get(f.path)
+                files.append(f)
+
+    if cache_file is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(json.dumps({
+            "patch": "".join(f.text for f in files),
+            "notes": {f.path: f.strategy for f in files if f.strategy},
+        }))
+        entries_by_age = sorted(cache_dir.iterdir(), key=lambda p: p.stat().st_mtime)
+        for stale in entries_by_age[:-INTERDIFF_CACHE_ENTRIES]:
+            stale.unlink(missing_ok=True)
+    return files
+
+
+class CatFile:
+    """A long-lived ``git cat-file --batch`` process.
+
+    Each lookup is one request/response on the pipe instead of a new git
+    process, so fetching many blobs (or serving them on demand) stays cheap.
+    """
+
+    def __init__(self) -> None:
+        import threading
+
+        self.proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.lock = threading.Lock()
+
+    def read(self, sha: str) -> bytes | None:
+        """Contents of blob ``sha``, or None if it doesn't exist or isn't a blob."""
+        with self.lock:
+            self.proc.stdin.write(sha.encode() + b"\n")
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3:  # "<sha> missing"
+                return None
+            data = self.proc.stdout.read(int(header[2]) + 1)[:-1]
+        return data if header[1] == b"blob" else None
+
+    def close(self) -> None:
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+# New-side blobs are embedded (zlib + base64) so hunk context can be
+# expanded in a static page; larger ones are only available with --serve.
+DEFAULT_EMBED_BLOB_SIZE = 256 << 10
+EMBED_TOTAL_LIMIT = 16 << 20
+
+
+def expandable(file: FileDiff) -> bool:
+    """Whether hunk context can be expanded, i.e. the diff omits unchanged lines."""
+    return (
+        file.status in ("M", "R", "C")
+        and bool(file.hunks)
+        and not file.binary
+        and not file.summarized
+        and not file.submodule  # its blobs live in another repo
+        and file.new_sha.strip("0") != ""
+    )
+
+
+def embed_blobs(files: list[FileDiff], cat_file: CatFile, max_size: int) -> dict[str, str]:
+    """Compressed new-side blobs of expandable files, keyed by sha."""
+    import base64
+    import zlib
+
+    blobs: dict[str, str] = {}
+    total = 0
+    for f in files:
+        if not expandable(f) or f.new_sha in blobs:
+            continue
+        data = cat_file.read(f.new_sha)
+        if data is None or len(data) > max_size or total + len(data) > EMBED_TOTAL_LIMIT:
+            continue
+        total += len(data)
+        blobs[f.new_sha] = base64.b64encode(zlib.compress(data, 6)).decode()
+    return blobs
+
+
+def iter_blame(commit: str, path: str) -> Iterator[dict[str, object]]:
+    """Runs of lines from ``git blame --incremental`` of ``path`` at ``commit``.
+
+    Each is a dict with the first line number, the run's length and its
+    commit's short id, author, author time and summary. They come in the
+    order git settles them, not by line.
+    """
+    cmd = ["git", "blame", "--incremental", "--porcelain", commit, "--", path]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    commits: dict[str, dict[str, object]] = {}
+    run = None
+    try:
+        for raw in proc.stdout:
+            key, _, value = raw.decode(errors="replace").rstrip("\n").partition(" ")
+            if run is None:
+                _, line, count = value.split()
+                run = (commits.setdefault(key, {"commit": key[:10]}), int(line), int(count))
+            elif key == "filename":
+                info, line, count = run
+                yield {**info, "line": line, "count": count}
+                run = None
+            elif key in ("author", "summary"):
+                run[0][key] = value
+            elif key == "author-time":
+                run[0]["time"] = int(value)
+    finally:
+        # Also stops git when the client goes away mid-stream.
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+
+
+def serve(
+    html: str,
+    cat_file: CatFile | None,
+    blob_shas: set[str],
+    blame: dict[str, tuple[str, str]] | None = None,
+    port: int = 0,
+    open_browser: bool = True,
 ) -> None:
+    """Serve the page, ``/blob/<sha>`` and ``/blame/<sha>`` until interrupted.
+
+    Only blobs referenced by the report are served. ``blame`` maps old blob
+    shas to the commit and path to blame them at; the result streams as
+    NDJSON runs (see ``iter_blame``) and is kept per blob.
+    """
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    page = html.encode()
+    blame = blame or {}
+    blamed: dict[str, bytes] = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path in ("/", "/index.html"):
+                self.reply(200, page, "text/html; charset=utf-8")
+            elif self.path.startswith("/blob/") and self.path[6:] in blob_shas:
+                data = cat_file.read(self.path[6:])
+                if data is None:
+                    self.reply(404, b"not found", "text/plain")
+                else:
+                    self.reply(200, data, "text/plain; charset=utf-8", cache=True)
+            elif self.path.startswith("/blame/") and self.path[7:] in blame:
+                self.send_blame(self.path[7:])
+            else:
+                self.reply(404, b"not found", "text/plain")
+
+        def send_blame(self, sha: str) -> None:
+            if sha in blamed:
+                return self.reply(200, blamed[sha], "application/x-ndjson")
+            # No Content-Length: the body ends when the connection closes.
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            runs = []
+            try:
+                for run in iter_blame(*blame[sha]):
+                    runs.append(json.dumps(run).encode() + b"\n")
+                    self.wfile.write(runs[-1])
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            blamed[sha] = b"".join(runs)
+
+        def reply(self, code: int, body: bytes, content_type: str, cache: bool = False) -> None:
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if cache:
+                # Blobs are content-addressed, so they never change.
+                self.send_header("Cache-Control", "max-age=31536000, immutable")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    console.print(f"[bold]Serving[/] {url} [dim](Ctrl-C to stop)[/]")
+    if open_browser:
+        import webbrowser
+
+        webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def file_rows(file: FileDiff) -> tuple[int, int]:
+    """Rows the file takes up in the unified and split views, for placeholder sizing."""
+    unified = split = 0
+    for hunk in file.hunks:
+        unified += 1
+        split += 1
+        dels = adds = 0
+        for line in hunk.lines + [" "]:
+            tag = line[:1]
+            if tag == "-":
+                dels += 1
+            elif tag == "+":
+                adds += 1
+            elif tag != "\\":
+                unified += dels + adds
+                split += max(dels, adds)
+                dels = adds = 0
+                unified += 1
+                split += 1
+        # Discount the sentinel context line appended above.
+        unified -= 1
+        split -= 1
+    return unified, split
+
+
+def file_stem(path: str) -> str | None:
+    """A file's name without its extension, if long enough to mask (see change_key)."""
+    name = path.rsplit("/", 1)[-1]
+    dot = name.rfind(".")
+    stem = name[:dot] if dot > 0 else name
+    return stem if len(stem) >= 3 else None
+
+
+def change_key(file: FileDiff) -> str | None:
+    """Hash of a file's hunk bodies with its own name masked out, or None.
+
+    Files with equal keys make the same change (typically a codemod) at
+    other line numbers, under other function context, or with their own
+    name in the changed lines. Masking is reversible, so the page can
+    rebuild each file's hunks from one copy.
+    """
+    if not file.hunks or file.summarized:
+        return None
+    import hashlib
+
+    stem = file_stem(file.path)
+    digest = hashlib.sha1()
+    for hunk in file.hunks:
+        body = "\n".join(hunk.lines)
+        if stem:
+            body = body.replace(stem, "\0")
+        digest.update(body.encode() + b"\n\1\n")
+    return digest.hexdigest()
+
+
+def find_duplicates(files: list[FileDiff]) -> list[int | None]:
+    """For each file, the index of an earlier file making the same change."""
+    first: dict[str, int] = {}
+    same: list[int | None] = []
+    for i, f in enumerate(files):
+        key = change_key(f)
+        j = first.setdefault(key, i) if key else i
+        same.append(j if j != i else None)
+    return same
+
+
+# Script each page renderer needs. diff2html's base bundle leaves out
+# highlight.js; the page loads its core and just the grammars the diff uses.
+RENDERER_SCRIPTS = {
+    "diff2html": '<script src="https://cdn.jsdelivr.net/npm/diff2html/bundles/js/diff2html-ui-base.min.js"></script>',
+    "native": "",
+}
+
+# highlight.js grammar by extension, file name and #! interpreter. Files
+# matching none of them (or their .gitattributes) aren't highlighted at all.
+LANGUAGE_EXTENSIONS = {
+    "py": "python", "pyi": "python", "pyw": "python",
+    "js": "javascript", "mjs": "javascript", "cjs": "javascript", "jsx": "javascript",
+    "ts": "typescript", "tsx": "typescript", "mts": "typescript", "cts": "typescript",
+    "json": "json", "jsonc": "json", "css": "css", "scss": "scss", "less": "less",
+    "html": "xml", "htm": "xml", "xml": "xml", "svg": "xml", "vue": "xml", "xsl": "xml", "plist": "xml",
+    "md": "markdown", "markdown": "markdown", "tex": "latex",
+    "yml": "yaml", "yaml": "yaml", "toml": "ini", "ini": "ini", "cfg": "ini",
+    "sh": "bash", "bash": "bash", "zsh": "bash", "ps1": "powershell",
+    "c": "c", "h": "c", "cc": "cpp", "cpp": "cpp", "cxx": "cpp", "hh": "cpp", "hpp": "cpp", "hxx": "cpp",
+    "m": "objectivec", "mm": "objectivec", "cs": "csharp", "fs": "fsharp",
+    "java": "java", "kt": "kotlin", "kts": "kotlin", "scala": "scala", "groovy": "groovy", "gradle": "groovy",
+    "go": "go", "rs": "rust", "swift": "swift", "dart": "dart", "rb": "ruby", "php": "php",
+    "pl": "perl", "pm": "perl", "lua": "lua", "r": "r", "jl": "julia",
+    "hs": "haskell", "ml": "ocaml", "mli": "ocaml", "ex": "elixir", "exs": "elixir", "erl": "erlang",
+    "clj": "clojure", "cljs": "clojure", "sql": "sql", "graphql": "graphql", "gql": "graphql",
+    "proto": "protobuf", "cmake": "cmake", "mk": "makefile", "nix": "nix", "vim": "vim",
+    "diff": "diff", "patch": "diff",
+}
+LANGUAGE_FILENAMES = {
+    "makefile": "makefile", "gnumakefile": "makefile", "dockerfile": "dockerfile",
+    "cmakelists.txt": "cmake", "gemfile": "ruby", "rakefile": "ruby", "vagrantfile": "ruby",
+}
+LANGUAGE_INTERPRETERS = {
+    "python": "python", "uv": "python", "sh": "bash", "bash": "bash", "zsh": "bash",
+    "node": "javascript", "deno": "typescript", "ruby": "ruby", "perl": "perl", "php": "php", "lua": "lua",
+}
+# Other spellings of grammars in linguist-language and diff attributes.
+LANGUAGE_ALIASES = {
+    "c++": "cpp", "c#": "csharp", "shell": "bash", "golang": "go", "objc": "objectivec",
+    "objective-c": "objectivec", "make": "makefile", "docker": "dockerfile",
+}
+GRAMMARS = frozenset(LANGUAGE_EXTENSIONS.values()) | {"dockerfile"}
+
+
+def grammar(name: str) -> str | None:
+    """The highlight.js grammar a language name or extension refers to, if any."""
+    name = name.lower()
+    if name in GRAMMARS:
+        return name
+    return LANGUAGE_ALIASES.get(name) or LANGUAGE_EXTENSIONS.get(name)
+
+
+def shebang_language(file: FileDiff) -> str | None:
+    """Grammar for the interpreter on a ``#!`` line that starts the new file."""
+    if not file.hunks or file.hunks[0].new_start != 1:
+        return None
+    first = next((line for line in file.hunks[0].lines if line[:1] in " +"), "")
+    if not first.startswith("#!", 1):
+        return None
+    words = first[3:].split()
+    if words and words[0].endswith("/env"):
+        words = [w for w in words[1:] if not w.startswith("-")]
+    if not words:
+        return None
+    return LANGUAGE_INTERPRETERS.get(os.path.basename(words[0]).rstrip("0123456789."))
+
+
+def detect_languages(files: list[FileDiff], root: str) -> list[str | None]:
+    """The highlight.js grammar for each file, or None to skip highlighting it.
+
+    A ``linguist-language`` or ``diff`` attribute from the repo at ``root``
+    wins, then the file name, its extension, and a ``#!`` line.
+    """
+    attributes: dict[str, str] = {}
+    if root and files:
+        result = git(
+            "-C", root, "check-attr", "-z", "--stdin", "linguist-language", "diff",
+            input="".join(f.path + "\0" for f in files),
+        )
+        fields = result.stdout.split("\0") if result.returncode == 0 else []
+        for path, _, value in zip(fields[0::3], fields[1::3], fields[2::3]):
+            # linguist-language comes first, so it wins over the diff driver.
+            if path not in attributes and grammar(value):
+                attributes[path] = grammar(value)
+    languages = []
+    for f in files:
+        name = f.path.rsplit("/", 1)[-1].lower()
+        ext = name.rsplit(".", 1)[-1] if "." in name else ""
+        languages.append(
+            attributes.get(f.path)
+            or LANGUAGE_FILENAMES.get(name)
+            or LANGUAGE_EXTENSIONS.get(ext)
+            or shebang_language(f)
+        )
+    return languages
+
+DEFAULT_DOM_BUDGET = 300_000
+DEFAULT_SHARD_SIZE = 4 << 20
+DATA_CHUNK_SIZE = 64 << 10
+
+
+def chunk_files(
+    file_meta: list[dict[str, object]],
+    file_data: list[dict[str, object]],
+    blobs: dict[str, str],
+    chunk_size: int,
+) -> Iterator[tuple[list[int], str, dict[str, str]]]:
+    """Group consecutive files into chunks of about ``chunk_size`` bytes.
+
+    Yields the file indices, a JSON object mapping each index to its data,
+    and the embedded blobs those files expand from.
+    """
+    indices: list[int] = []
+    texts: list[str] = []
+    chunk_blobs: dict[str, str] = {}
+    size = 0
+    for i, (meta, data) in enumerate(zip(file_meta, file_data)):
+        text = script_json(data)
+        blob = meta.get("blob")
+        blob_text = blobs.get(blob, "") if blob else ""
+        if indices and size + len(text) + len(blob_text) > chunk_size:
+            yield indices, "{" + ",".join(texts) + "}", chunk_blobs
+            indices, texts, chunk_blobs, size = [], [], {}, 0
+        indices.append(i)
+        texts.append(f'"{i}":{text}')
+        if blob_text:
+            chunk_blobs[blob] = blob_text
+        size += len(text) + len(blob_text)
+    if indices:
+        yield indices, "{" + ",".join(texts) + "}", chunk_blobs
+
+
+def write_shards(
+    out_dir: Path,
+    file_meta: list[dict[str, object]],
+    file_data: list[dict[str, object]],
+    blobs: dict[str, str],
+    shard_size: int = DEFAULT_SHARD_SIZE,
+) -> list[str]:
+    """Split per-file data into ``shard-NNNN.js`` files of about ``shard_size`` bytes.
+
+    Each shard holds consecutive files (and the blobs they expand from) and
+    is loaded by the index page when one of its files is scrolled to. Sets
+    ``file_meta[i]["shard"]`` and returns the shard file names.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for old in out_dir.glob("shard-*.js"):
+        old.unlink()
+    names: list[str] = []
+    for k, (indices, files_json, chunk_blobs) in enumerate(chunk_files(file_meta, file_data, blobs, shard_size)):
+        name = f"shard-{k:04d}.js"
+        (out_dir / name).write_text(f"ajdiffShard({k},{files_json},{script_json(chunk_blobs)});\n")
+        names.append(name)
+        for i in indices:
+            file_meta[i]["shard"] = k
+    return names
+
+
+def data_blocks(
+    file_meta: list[dict[str, object]],
+    file_data: list[dict[str, object]],
+    blobs: dict[str, str],
+    chunk_size: int = DATA_CHUNK_SIZE,
+) -> Iterator[str]:
+    """The per-file data that follows the page shell (see ajdiffData in the page)."""
+    for _, files_json, chunk_blobs in chunk_files(file_meta, file_data, blobs, chunk_size):
+        yield (
+            f'<script type="application/json">{{"files":{files_json},"blobs":{script_json(chunk_blobs)}}}</script>'
+            "<script>ajdiffData()</script>\n"
+        )
+
+
+# Render planner: past these sizes a file starts out drawn more cheaply. The
+# page lists what was left out, and each file can still be drawn in full.
+PLAN_WORDS_MAX_LINES = 2000  # changed lines, before word-level marks are skipped
+PLAN_HIGHLIGHT_MAX_ROWS = 5000  # before syntax highlighting is skipped
+PLAN_HIGHLIGHT_MAX_LINE = 5000  # characters, e.g. minified code
+PLAN_COLLAPSE_ROWS = 20000  # before the file starts collapsed
+PLAN_UNIFIED_ROWS = 50000  # in the whole diff, before unified view is the default
+
+
+def plan_file(file: FileDiff, rows: int, highlighted: bool, words: bool) -> dict[str, str] | None:
+    """How to draw a file of ``rows`` rows more cheaply: downgrades and their reasons.
+
+    ``highlighted`` and ``words`` say whether it would get syntax and
+    word-level highlighting at all. None means draw it in full.
+    """
+    changed = longest = 0
+    for hunk in file.hunks:
+        for line in hunk.lines:
+            changed += line.startswith(("+", "-"))
+            longest = max(longest, len(line) - 1)
+    plan = {}
+    if rows > PLAN_COLLAPSE_ROWS:
+        plan["collapsed"] = f"{rows:,} rows"
+    if highlighted and rows > PLAN_HIGHLIGHT_MAX_ROWS:
+        plan["highlight"] = f"{rows:,} rows"
+    elif highlighted and longest > PLAN_HIGHLIGHT_MAX_LINE:
+        plan["highlight"] = f"a {longest:,}-character line"
+    if words and changed > PLAN_WORDS_MAX_LINES:
+        plan["words"] = f"{changed:,} changed lines"
+    return plan or None
+
+
+def plan_view(file_meta: list[dict[str, object]]) -> str | None:
+    """The view a diff should open in when the reader hasn't chosen one, if not split."""
+    rows = sum(m["rows"][0] for m in file_meta if not m["plan"] or "collapsed" not in m["plan"])
+    return "line-by-line" if rows > PLAN_UNIFIED_ROWS else None
+
+
+def page_files(
+    files: list[FileDiff],
+    repo_root: str,
+    cat_file: CatFile | None = None,
+    embed_blob_size: int = 0,
+    dedup: bool = True,
+    plan: bool = True,
+    serve: bool = False,
+    blame_commit: str | None = None,
+    profiler: Profiler | None = None,
+) -> tuple[list[dict[str, object]], list[dict[str, object]], dict[str, str]]:
+    """The page's metadata and data for each file, plus the blobs to embed.
+
+    Blobs up to ``embed_blob_size`` are read through ``cat_file``, unless
+    ``serve`` is set: then the server hands them out, and blames files at
+    ``blame_commit``. With ``plan``, large files get a render plan (see
+    ``plan_file``).
+    """
+    import hashlib
+
+    profiler = profiler or Profiler()
+    with profiler.phase("dedup"):
+        same = find_duplicates(files) if dedup else [None] * len(files)
+
+    with profiler.phase("intraline"):
+        deadline = time.perf_counter() + INTRALINE_TOTAL_BUDGET
+        words = [None if s is not None else intraline_changes(f, deadline) for f, s in zip(files, same)]
+
+    blobs: dict[str, str] = {}
+    if cat_file is not None and not serve:
+        with profiler.phase("embed blobs"):
+            blobs = embed_blobs([f for f, s in zip(files, same) if s is None], cat_file, embed_blob_size)
+
+    with profiler.phase("languages"):
+        languages = detect_languages(files, repo_root)
+
+    file_sizes = [(0, 0) if s is not None else file_rows(f) for f, s in zip(files, same)]
+    file_meta = [
+        {
+            "path": f.path,
+            "status": f.status,
+            "strategy": f.strategy,
+            "summarized": f.summarized,
+            "old_path": f.old_path if f.status in ("R", "C") else None,
+            "lang": lang,
+            # Old blob the server blames on request (--serve only).
+            "blame": f.old_sha if serve and blame_commit and expandable(f) else None,
+            # Blob to expand hunk context from, if the page can get at it.
+            "blob": f.new_sha if expandable(f) and (serve or f.new_sha in blobs) else None,
+            "rows": rows,
+            # Cheaper ways to draw it, with reasons (see plan_file).
+            "plan": plan_file(f, rows[0], lang is not None, w is not None) if plan and s is None else None,
+            "shard": None,
+            # Earlier file making the same change; this one is drawn from its hunks.
+            "same": s,
+            # What "viewed" marks are keyed by in the page. Blobs alone aren't
+            # unique: every empty __init__.py added is the same change.
+            "key": f"{f.path}:{f.old_sha}..{f.new_sha}" if f.old_sha else f"{f.old_path}..{f.new_path}",
+            # What drawn HTML is cached under in the browser (see cacheKey).
+            "hash": hashlib.sha1(f.text.encode()).hexdigest()[:20],
+        }
+        for f, lang, s, w, rows in zip(files, languages, same, words, file_sizes)
+    ]
+    file_data: list[dict[str, object]] = [
+        {"header": f.header, "hunks": [h.header for h in f.hunks]} if s is not None
+        else {"patch": f.text, "words": w}
+        for f, w, s in zip(files, words, same)
+    ]
+    return file_meta, file_data, blobs
+
+
+def write_page(
+    out: TextIO,
+    file_meta: list[dict[str, object]],
+    file_data: list[dict[str, object]],
+    blobs: dict[str, str],
+    title: str,
+    meta: str,
+    commits_html: str = "",
+    num_commits: int = 0,
+    shard_files: list[str] | None = None,
+    repo_root: str = "",
+    renderer: str = "diff2html",
+    dom_budget: int = DEFAULT_DOM_BUDGET,
+    serve: bool = False,
+    view: str | None = None,
+    build_profile: dict[str, object] | None = None,
+) -> int:
+    """Write the page to ``out``, streaming the data blocks in as they are serialized.
+
+    With ``shard_files`` the data lives in the shards instead. ``view`` is
+    the one to open in until the reader picks one (see ``plan_view``).
+    Returns the number of characters written.
+    """
+    fields = dict(
+        title=title,
+        meta=meta,
+        num_commits=num_commits,
+        commits_html=commits_html,
+        files_json=script_json(file_meta),
+        shards_json=script_json(shard_files or []),
+        blob_url=script_json("/blob/" if serve else None),
+        blame_url=script_json("/blame/" if serve else None),
+        repo_root=script_json(repo_root),
+        planned_view=script_json(view),
+        build_profile=script_json(build_profile or {}),
+        renderer=script_json(renderer),
+        dom_budget=dom_budget,
+        renderer_script=RENDERER_SCRIPTS[renderer],
+        languages_json=script_json(sorted({m["lang"] for m in file_meta if m["lang"]})),
+    )
+    shell, _, tail = HTML_TEMPLATE.partition("{data_blocks}")
+    written = out.write(shell.format(**fields))
+    if not shard_files:
+        for block in data_blocks(file_meta, file_data, blobs):
+            written += out.write(block)
+    return written + out.write(tail.format(**fields))
+
+
+# --daemon keeps one process per git dir listening on a Unix socket in it;
+# while the socket exists, the CLI forwards its arguments there instead of
+# doing the work itself.
+DAEMON_SOCKET = "ajdiff.sock"
+DAEMON_IDLE_SECONDS = 3600
+DAEMON_MAX_DIFFS = 16
+
+
+class RepoCache:
+    """Warm per-repo state kept by the daemon between invocations.
+
+    Ref-dependent git output (the default branch, merge bases, ...) is
+    memoized until HEAD, the index, packed-refs, the repo config or anything
+    under refs/ changes on disk. Parsed diffs are keyed by the commit ids
+    they were computed from, so moving refs doesn't invalidate them; they
+    are only dropped when the config changes (it can change git's diff
+    output) or to stay under ``DAEMON_MAX_DIFFS``.
+    """
+
+    def __init__(self, git_dir: Path, common_dir: Path) -> None:
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        self.outputs: dict[tuple[object, ...], object] = {}
+        self.diffs: dict[tuple[object, ...], tuple[list[FileDiff], dict[str, float]]] = {}
+        self.ref_stamp: tuple[int, ...] = ()
+        self.config_stamp: tuple[int, ...] = ()
+        self.hits = 0
+        self.misses = 0
+        self.opened: str | None = None
+        # Set when a request has to run in the client instead (see main).
+        self.local = False
+        self._cat_file: CatFile | None = None
+
+    def refresh(self) -> None:
+        """Drop whatever the on-disk repo state no longer matches."""
+        config_stamp = self._stamp([self.common_dir / "config", Path.home() / ".gitconfig"])
+        if config_stamp != self.config_stamp:
+            self.config_stamp = config_stamp
+            self.outputs.clear()
+            self.diffs.clear()
+        files = [self.git_dir / "HEAD", self.git_dir / "index", self.common_dir / "packed-refs"]
+        # Loose refs are replaced by rename, which touches their directory.
+        dirs = [Path(d) for d, _, _ in os.walk(self.common_dir / "refs")]
+        ref_stamp = self._stamp(files) + tuple(os.stat(d).st_mtime_ns for d in dirs)
+        if ref_stamp != self.ref_stamp:
+            self.ref_stamp = ref_stamp
+            self.outputs.clear()
+
+    @staticmethod
+    def _stamp(paths: list[Path]) -> tuple[int, ...]:
+        stamp: list[int] = []
+        for p in paths:
+            try:
+                st = os.stat(p)
+            except OSError:
+                stamp += (0, 0)
+            else:
+                stamp += (st.st_mtime_ns, st.st_ino)
+        return tuple(stamp)
+
+    def memo(self, key: tuple[object, ...], compute):
+        key = (os.getcwd(), *key)
+        if key in self.outputs:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.outputs[key] = compute()
+        return self.outputs[key]
+
+    def git(self, *args: str) -> subprocess.CompletedProcess[str]:
+        return self.memo(("git", *args), lambda: git(*args))
+
+    def default_branch(self) -> str:
+        return self.memo(("default branch",), get_default_branch)
+
+    def repo_info(self) -> RepoInfo | None:
+        return self.memo(("repo info",), repo_info)
+
+    def collect_diff(self, base: str, head: str, *args: object, timings: dict[str, float], **kwargs: object) -> list[FileDiff]:
+        """``collect_diff``, reusing the result for the same commits and options."""
+        resolved = self.git("rev-parse", "--verify", "--end-of-options", f"{base}^{{commit}}"), self.git(
+            "rev-parse", "--verify", "--end-of-options", f"{head}^{{commit}}"
+        )
+        if any(r.returncode for r in resolved):
+            return collect_diff(base, head, *args, timings=timings, **kwargs)
+        key = (
+            os.getcwd(), *(r.stdout.strip() for r in resolved),
+            repr(args), repr(sorted(kwargs.items())),
+        )
+        if key in self.diffs:
+            self.hits += 1
+            files, cached_timings = self.diffs.pop(key)
+        else:
+            self.misses += 1
+            cached_timings = {}
+            files = collect_diff(base, head, *args, timings=cached_timings, **kwargs)
+            while len(self.diffs) >= DAEMON_MAX_DIFFS:
+                del self.diffs[next(iter(self.diffs))]
+        self.diffs[key] = files, cached_timings
+        timings.update(cached_timings)
+        return files
+
+    def cat_file(self) -> CatFile:
+        if self._cat_file is None:
+            self._cat_file = CatFile()
+        return self._cat_file
+
+    def close(self) -> None:
+        if self._cat_file is not None:
+            self._cat_file.close()
+
+
+class DaemonStream:
+    """File-like object forwarding a request's stdout or stderr to the client."""
+
+    def __init__(self, send, key: str = "err") -> None:
+        self.send = send
+        self.key = key
+
+    def write(self, text: str) -> int:
+        if text:
+            self.send({self.key: text})
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    def isatty(self) -> bool:
+        return False
+
+
+def find_git_dir(start: Path) -> Path | None:
+    """The git dir for ``start``, found without running git (the client's fast path)."""
+    if "GIT_DIR" in os.environ:
+        return Path(os.environ["GIT_DIR"]).resolve()
+    for d in (start, *start.parents):
+        dot = d / ".git"
+        if dot.is_dir():
+            return dot.resolve()
+        if dot.is_file():
+            text = dot.read_text()
+            if not text.startswith("gitdir:"):
+                return None
+            return (d / text[7:].strip()).resolve()
+    return None
+
+
+def daemon_request(sock_path: Path, message: dict[str, object]) -> Iterator[dict[str, object]]:
+    """Send one request to the daemon and yield its replies.
+
+    Raises ``OSError`` if no daemon is listening.
+    """
+    import json
+    import socket
+
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(str(sock_path))
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile("rb") as replies:
+            for line in replies:
+                yield json.loads(line)
+
+
+def forward_to_daemon(argv: list[str]) -> int | None:
+    """Run ``argv`` in this repo's daemon, if one is running.
+
+    Returns the exit code, or None if the command should run locally.
+    """
+    git_dir = find_git_dir(Path.cwd())
+    if git_dir is None or not (git_dir / DAEMON_SOCKET).exists():
+        return None
+    message = {"argv": argv, "cwd": os.getcwd(), "color": console.color}
+    try:
+        for reply in daemon_request(git_dir / DAEMON_SOCKET, message):
+            if "out" in reply:
+                sys.stdout.write(reply["out"])
+            elif "err" in reply:
+                sys.stderr.write(reply["err"])
+                sys.stderr.flush()
+            elif "exit" in reply:
+                if reply.get("local"):
+                    return None
+                if reply.get("open"):
+                    import webbrowser
+
+                    webbrowser.open(reply["open"])
+                return reply["exit"]
+    except BrokenPipeError:
+        return close_stdout()
+    except OSError:
+        pass
+    return None
+
+
+def handle_request(request: dict[str, object], cache: RepoCache, send) -> None:
+    """Run one forwarded invocation of ``main`` inside the daemon."""
+    from contextlib import redirect_stderr, redirect_stdout
+
+    stream = DaemonStream(send)
+    saved = console.file, console.color
+    console.file, console.color = stream, bool(request.get("color"))
+    cache.opened = None
+    cache.local = False
+    try:
+        os.chdir(request["cwd"])
+        cache.refresh()
+        with redirect_stdout(DaemonStream(send, "out")), redirect_stderr(stream):
+            code = main(request["argv"], cache=cache)
+    except SystemExit as e:  # argparse errors and --help
+        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        import traceback
+
+        stream.write(traceback.format_exc())
+        code = 1
+    finally:
+        console.file, console.color = saved
+    send({"exit": code, "open": cache.opened, "local": cache.local})
+
+
+def run_daemon(git_dir: Path) -> int:
+    """Serve forwarded invocations for the repo at ``git_dir`` until stopped or idle."""
+    import json
+    import socket
+
+    common = git("rev-parse", "--path-format=absolute", "--git-common-dir")
+    cache = RepoCache(git_dir, Path(common.stdout.strip()) if common.returncode == 0 else git_dir)
+    sock_path = git_dir / DAEMON_SOCKET
+    sock_path.unlink(missing_ok=True)
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(str(sock_path))
+    os.chmod(sock_path, 0o600)
+    server.listen()
+    server.settimeout(DAEMON_IDLE_SECONDS)
+    started = time.time()
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except TimeoutError:
+                break
+            conn.settimeout(None)
+            stopping = False
+            # Closing the stream flushes it, so a client that hung up
+            # mid-reply can fail the with's exit too.
+            try:
+                with conn, conn.makefile("rwb") as stream:
+
+                    def send(reply: dict[str, object]) -> None:
+                        stream.write(json.dumps(reply).encode() + b"\n")
+                        stream.flush()
+
+                    request = json.loads(stream.readline())
+                    if request.get("stop"):
+                        stopping = True
+                        send({"exit": 0})
+                    elif request.get("status"):
+                        send({
+                            "exit": 0, "pid": os.getpid(), "uptime": time.time() - started,
+                            "diffs": len(cache.diffs), "hits": cache.hits, "misses": cache.misses,
+                        })
+                    else:
+                        handle_request(request, cache, send)
+            except (OSError, ValueError):
+                pass  # client went away or sent garbage
+            if stopping:
+                break
+    finally:
+        server.close()
+        sock_path.unlink(missing_ok=True)
+        cache.close()
+    return 0
+
+
+def daemon_command(action: str) -> int:
+    """``ajdiff --daemon start|stop|status|run``."""
+    result = git("rev-parse", "--absolute-git-dir")
+    if result.returncode != 0:
+        console.print("[bold red]Error:[/] not inside a git repository.")
+        return 1
+    git_dir = Path(result.stdout.strip()).resolve()
+    sock_path = git_dir / DAEMON_SOCKET
+    if action == "run":
+        return run_daemon(git_dir)
+
+    def ask(message: dict[str, object]) -> dict[str, object] | None:
+        try:
+            return next(daemon_request(sock_path, message), None)
+        except OSError:
+            return None
+
+    status = ask({"status": True})
+    if action == "status":
+        if status is None:
+            console.print("[dim]ajdiff daemon not running[/]")
+            return 1
+        console.print(
+            f"ajdiff daemon [bold]{status['pid']}[/] up {status['uptime']:.0f}s, "
+            f"{status['diffs']} cached diffs, {status['hits']} hits / {status['misses']} misses"
+        )
+        return 0
+    if action == "stop":
+        if status is None:
+            console.print("[dim]ajdiff daemon not running[/]")
+            return 0
+        ask({"stop": True})
+        console.print(f"[dim]stopped ajdiff daemon {status['pid']}[/]")
+        return 0
+    if status is not None:
+        console.print(f"[dim]ajdiff daemon already running ({status['pid']})[/]")
+        return 0
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--daemon", "run"],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and proc.poll() is None:
+        if (status := ask({"status": True})) is not None:
+            console.print(f"[dim]started ajdiff daemon {status['pid']} ({sock_path})[/]")
+            return 0
+        time.sleep(0.02)
+    console.print("[bold red]Error:[/] the ajdiff daemon did not start.")
+    return 1
+
+
+def build_pathspec(paths: list[str], excludes: list[str]) -> list[str]:
+    """Git pathspec for the given paths minus the ``excludes`` globs.
+
+    Paths are relative to the current directory, as with git itself. With
+    only excludes, they apply to the whole repository.
+    """
+    if not paths and not excludes:
+        return []
+    return [*(paths or [":/"]), *(f":(exclude){glob}" for glob in excludes)]
+
+
+def write_profile(target: str, report: dict[str, object]) -> None:
+    """Write a --profile report as JSON to ``target`` ("-" for stderr)."""
+    import json
+
+    text = json.dumps(report, indent=2)
+    if target == "-":
+        print(text, file=sys.stderr)
+    else:
+        Path(target).write_text(text + "\n")
+
+
+def file_record(file: FileDiff, hunks: bool = False) -> dict[str, object]:
+    """One file of ``--format json/ndjson`` output.
+
+    A summarized file's line counts are unknown, so they are None.
+    """
+    lines = [line for hunk in file.hunks for line in hunk.lines]
+    record: dict[str, object] = {
+        "path": file.path,
+        "old_path": None if file.status == "A" else file.old_path,
+        "status": file.status,
+        "additions": None if file.summarized else sum(line.startswith("+") for line in lines),
+        "deletions": None if file.summarized else sum(line.startswith("-") for line in lines),
+        "binary": file.binary,
+        "summarized": file.summarized,
+    }
+    if hunks:
+        record["hunks"] = [
+            {
+                "header": h.header,
+                "old_start": h.old_start,
+                "old_count": h.old_count,
+                "new_start": h.new_start,
+                "new_count": h.new_count,
+                "lines": h.lines,
+            }
+            for h in file.hunks
+        ]
+    return record
+
+
+def write_records(files: Iterable[FileDiff], out, fmt: str, hunks: bool = False) -> int:
+    """Write one record per file as a JSON array or NDJSON, as the files arrive.
+
+    Returns the number of records written.
+    """
+    import json
+
+    count = 0
+    for f in files:
+        text = json.dumps(file_record(f, hunks))
+        if fmt == "json":
+            out.write(("[\n  " if count == 0 else ",\n  ") + text)
+        else:
+            out.write(text + "\n")
+        count += 1
+    if fmt == "json":
+        out.write("\n]\n" if count else "[]\n")
+    return count
+
+
+# --dataset writes three tables: one row per base...head pair, per changed
+# file and per hunk. "pair_index" and "file_index" columns are row numbers into the
+# pairs and files tables.
+DATASET_FORMATS = ("parquet", "arrow", "npz")
+DATASET_MODULES = {"parquet": "pyarrow", "arrow": "pyarrow", "npz": "numpy"}
+# Column types, so a column whose values are all None (say, old_path when a
+# pair only adds files) still gets written as strings.
+DATASET_COLUMNS: dict[str, dict[str, type]] = {
+    "pairs": {
+        "base": str, "head": str, "base_sha": str, "head_sha": str, "merge_base": str, "commits": int,
+        "head_time": int, "head_author": str, "head_subject": str, "files": int, "additions": int, "deletions": int,
+    },
+    "files": {
+        "pair_index": int, "path": str, "old_path": str, "status": str, "additions": int, "deletions": int,
+        "hunks": int, "binary": bool, "summarized": bool,
+    },
+    "hunks": {
+        "pair_index": int, "file_index": int, "old_start": int, "old_count": int,
+        "new_start": int, "new_count": int, "additions": int, "deletions": int,
+    },
+}
+
+
+def parse_pairs(text: str) -> list[tuple[str, str]]:
+    """Parse ``--pairs``: one ``base...head``, ``base head`` or ``base`` (vs HEAD) per line."""
+    pairs = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        refs = line.split("...", 1) if "..." in line else line.split()
+        pairs.append((refs[0], refs[1] if len(refs) > 1 else "HEAD"))
+    return pairs
+
+
+def dataset_tables(
+    base: str,
+    head: str,
+    flags: list[str],
+    rename_flags: list[str],
+    max_file_size: int,
+    file_timeout: float,
+    pathspec: list[str],
+) -> dict[str, dict[str, list[object]]]:
+    """Columns of the pairs, files and hunks tables for one ``base...head``.
+
+    Runs in a worker process. "pair_index" is always 0 and "file_index" counts from 0;
+    the caller offsets them.
+    """
+    files = collect_diff(
+        base, head, flags, rename_flags,
+        max_file_size=max_file_size, file_timeout=file_timeout, pathspec=pathspec,
+    )
+    base_sha, head_sha = git_checked("rev-parse", f"{base}^{{commit}}", f"{head}^{{commit}}").stdout.split()
+    time_, author, subject = git_checked("log", "-1", "--format=%ct%x00%an%x00%s", head_sha).stdout.rstrip("\n").split("\0")
+    commits = int(git_checked("rev-list", "--count", f"{base_sha}..{head_sha}").stdout)
+
+    file_cols: dict[str, list[object]] = {k: [] for k in DATASET_COLUMNS["files"]}
+    hunk_cols: dict[str, list[object]] = {k: [] for k in DATASET_COLUMNS["hunks"]}
+    for i, f in enumerate(files):
+        record = file_record(f)
+        if f.summarized:  # int columns; the summarized column marks the counts as missing
+            record["additions"] = record["deletions"] = 0
+        for key in ("path", "old_path", "status", "additions", "deletions", "binary", "summarized"):
+            file_cols[key].append(record[key])
+        file_cols["pair_index"].append(0)
+        file_cols["hunks"].append(len(f.hunks))
+        for h in f.hunks:
+            hunk_cols["pair_index"].append(0)
+            hunk_cols["file_index"].append(i)
+            hunk_cols["old_start"].append(h.old_start)
+            hunk_cols["old_count"].append(h.old_count)
+            hunk_cols["new_start"].append(h.new_start)
+            hunk_cols["new_count"].append(h.new_count)
+            hunk_cols["additions"].append(sum(line.startswith("+") for line in h.lines))
+            hunk_cols["deletions"].append(sum(line.startswith("-") for line in h.lines))
+    pair_cols: dict[str, list[object]] = {
+        "base": [base], "head": [head], "base_sha": [base_sha], "head_sha": [head_sha],
+        "merge_base": [get_merge_base(base_sha, head_sha)], "commits": [commits],
+        "head_time": [int(time_)], "head_author": [author], "head_subject": [subject],
+        "files": [len(files)],
+        "additions": [sum(file_cols["additions"])], "deletions": [sum(file_cols["deletions"])],
+    }
+    return {"pairs": pair_cols, "files": file_cols, "hunks": hunk_cols}
+
+
+def build_dataset(
+    pairs: list[tuple[str, str]],
+    jobs: int,
+    *options: object,
+) -> tuple[dict[str, dict[str, list[object]]], list[tuple[str, str, str]]]:
+    """Diff every pair (``jobs`` at a time) and concatenate their tables in input order.
+
+    ``options`` are passed on to ``dataset_tables``. Returns the tables and
+    ``(base, head, error)`` for the pairs that failed.
+    """
+    tables: dict[str, dict[str, list[object]]] = {}
+    failed = []
+    if jobs > 1 and len(pairs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        pool = ProcessPoolExecutor(max_workers=min(jobs, len(pairs)))
+        results = [pool.submit(dataset_tables, base, head, *options).result for base, head in pairs]
+    else:
+        from functools import partial
+
+        pool = None
+        results = [partial(dataset_tables, base, head, *options) for base, head in pairs]
+    try:
+        for (base, head), result in zip(pairs, results):
+            try:
+                part = result()
+            except subprocess.CalledProcessError as e:
+                failed.append((base, head, (e.stderr or "").strip()))
+                continue
+            pair_offset = len(tables.get("pairs", {}).get("base", []))
+            file_offset = len(tables.get("files", {}).get("path", []))
+            part["files"]["pair_index"] = [pair_offset] * len(part["files"]["path"])
+            part["hunks"]["pair_index"] = [pair_offset] * len(part["hunks"]["file_index"])
+            part["hunks"]["file_index"] = [i + file_offset for i in part["hunks"]["file_index"]]
+            for name, cols in part.items():
+                table = tables.setdefault(name, {k: [] for k in cols})
+                for key, values in cols.items():
+                    table[key].extend(values)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return tables, failed
+
+
+def write_dataset(out_dir: Path, tables: dict[str, dict[str, list[object]]], fmt: str) -> list[Path]:
+    """Write each table to ``out_dir`` as Parquet, Arrow IPC or a NumPy ``.npz``.
+
+    Column types come from ``DATASET_COLUMNS``, not the values.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for name, cols in tables.items():
+        types = DATASET_COLUMNS[name]
+        if fmt == "npz":
+            import numpy as np
+
+            path = out_dir / f"{name}.npz"
+            # Strings as fixed-width unicode (None as "") so the file loads without pickle.
+            dtypes = {str: np.str_, int: np.int64, bool: np.bool_}
+            np.savez_compressed(path, **{
+                k: np.asarray(["" if x is None else x for x in v] if types[k] is str else v, dtype=dtypes[types[k]])
+                for k, v in cols.items()
+            })
+        else:
+            import pyarrow as pa
+
+            arrow_types = {str: pa.string(), int: pa.int64(), bool: pa.bool_()}
+            table = pa.table(cols, schema=pa.schema([(k, arrow_types[types[k]]) for k in cols]))
+            if fmt == "parquet":
+                import pyarrow.parquet as pq
+
+                path = out_dir / f"{name}.parquet"
+                pq.write_table(table, path)
+            else:
+                import pyarrow.feather as feather
+
+                path = out_dir / f"{name}.arrow"
+                feather.write_feather(table, path)
+        paths.append(path)
+    return paths
+
+
+def close_stdout() -> int:
+    """Stop writing to a pipe whose reader (e.g. ``head``) has gone away."""
+    if isinstance(sys.stdout, DaemonStream):
+        return 0  # the daemon drops the connection; its own stdout is fine
+    # Pointing stdout at devnull keeps the interpreter's final flush from failing too.
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return 0
+
+
+def script_json(value: object) -> str:
+    """JSON for embedding inside a ``<script>`` element."""
+    import json
+
+    # "</" would let content like "</script>" close the element early, and
+    # "<!--" can put the parser in a state where it skips the real end tag.
+    return json.dumps(value).replace("</", "<\\/").replace("<!--", "<\\u0021--")
+
+
+# Library API: the CLI's building blocks for tools that embed ajdiff. Like
+# the CLI, they work on the repository in the current directory; they print
+# nothing and raise subprocess.CalledProcessError when git fails.
+class DiffStats(namedtuple("DiffStats", "files additions deletions")):
+    """Number of files changed and lines added and deleted."""
+
+    __slots__ = ()
+
+
+def iter_files(
+    base: str | None = None,
+    head: str = "HEAD",
+    paths: Iterable[str] = (),
+    excludes: Iterable[str] = (),
+    diff_algorithm: str | None = None,
+    renames: bool = True,
+    max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+    file_timeout: float = DEFAULT_FILE_TIMEOUT,
+) -> Iterator[FileDiff]:
+    """Yield each file changed on ``head`` since it branched off ``base``, parsed into hunks.
+
+    ``base`` defaults to the default branch. Files come in git's order as
+    soon as git prints them. ``paths`` and ``excludes`` narrow the diff as
+    on the command line; the size and time budget is ``--max-file-size``
+    and ``--file-timeout``'s.
+    """
+    flags = [f"--diff-algorithm={diff_algorithm}"] if diff_algorithm else []
+    return iter_diff(
+        base or get_default_branch(), head, flags, None if renames else ["--no-renames"],
+        max_file_size, file_timeout, build_pathspec(list(paths), list(excludes)),
+    )
+
+
+def diff_stats(files: Iterable[FileDiff]) -> DiffStats:
+    """Count files and added and deleted lines, consuming ``files`` as it goes."""
+    num_files = additions = deletions = 0
+    for f in files:
+        num_files += 1
+        for hunk in f.hunks:
+            for line in hunk.lines:
+                if line.startswith("+"):
+                    additions += 1
+                elif line.startswith("-"):
+                    deletions += 1
+    return DiffStats(num_files, additions, deletions)
+
+
+def render_html(
+    files: Iterable[FileDiff],
+    out: TextIO,
+    title: str = "ajdiff",
+    renderer: str = "diff2html",
+    dedup: bool = True,
+    plan: bool = True,
+    embed_blob_size: int = DEFAULT_EMBED_BLOB_SIZE,
+    dom_budget: int = DEFAULT_DOM_BUDGET,
+) -> int:
+    """Write a standalone diff page for ``files`` to the text stream ``out``.
+
+    The options match the CLI's. Returns the number of characters written.
+    """
+    files = list(files)
+    root = git("rev-parse", "--show-toplevel")
+    repo_root = root.stdout.strip() if root.returncode == 0 else ""
+    cat_file = CatFile() if embed_blob_size and any(map(expandable, files)) else None
+    try:
+        file_meta, file_data, blobs = page_files(files, repo_root, cat_file, embed_blob_size, dedup, plan)
+    finally:
+        if cat_file is not None:
+            cat_file.close()
+    stats = diff_stats(files)
+    return write_page(
+        out, file_meta, file_data, blobs, title, f"{stats.files} files changed",
+        repo_root=repo_root, renderer=renderer, dom_budget=dom_budget, view=plan_view(file_meta) if plan else None,
+    )
+
+
+RENAME_OPTIONS = {"-M": "--find-renames", "-C": "--find-copies"}
+
+
+def attach_rename_thresholds(options: list[str]) -> list[str]:
+    """Read ``-M``/``-C`` thresholds the way git does: only when attached.
+
+    ``-M50%`` and ``--find-renames=50%`` set one; a bare ``-M`` becomes
+    ``--find-renames=`` so the word after it stays a positional (``-M main``).
+    """
+    out = []
+    for option in options:
+        for short, long in RENAME_OPTIONS.items():
+            if option in (short, long):
+                option = long + "="
+            elif option.startswith(short):
+                option = f"{long}={option[2:]}"
+        out.append(option)
+    return out
+
+
+def build_parser() -> "argparse.ArgumentParser":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="ajdiff",
+        description="Generate a GitHub-PR-like diff view in the browser.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""\
+examples:
+  ajdiff                     # diff current branch vs main/master
+  ajdiff main                # diff current branch vs main
+  ajdiff v4.0.0              # diff current branch vs a tag
+  ajdiff feature-a feature-b # diff between two refs
+  ajdiff main -- src/ docs/  # only changes under src/ and docs/
+  ajdiff --exclude '*.lock'  # everything except lockfiles
+""",
+    )
+    parser.usage = "%(prog)s [options] [base] [head] [-- pathspec...]"
+    parser.add_argument(
+        "base", nargs="?", default=None,
+        help="Base ref to diff against (default: auto-detected).",
+    )
+    parser.add_argument("head", nargs="?", default="HEAD", help="Head ref (default: HEAD).")
+    parser.add_argument(
+        "--output", "-o", type=Path, default=None,
+        help="Save HTML to this path instead of a temp file.",
+    )
+    parser.add_argument(
+        "--no-open", action="store_true",
+        help="Print the file path without opening the browser.",
+    )
+    parser.add_argument(
+        "--format", choices=("html", "json", "ndjson"), default="html",
+        help="json/ndjson: stream one record per file (path, old_path, status, "
+        "additions, deletions) to stdout or --output instead of building the page.",
+    )
+    parser.add_argument(
+        "--hunks", action="store_true",
+        help="Include each file's hunks in --format json/ndjson records.",
+    )
+    parser.add_argument(
+        "--serve", action="store_true",
+        help="Serve the page from a local server instead of writing a file; "
+        "hunk context can then be expanded for files of any size.",
+    )
+    parser.add_argument(
+        "--port", type=int, default=0,
+        help="Port for --serve (default: any free port).",
+    )
+    parser.add_argument(
+        "--shard", type=Path, default=None, metavar="DIR",
+        help="Write DIR/index.html plus shard files loaded on navigation, "
+        "so enormous diffs open fast.",
+    )
+    parser.add_argument(
+        "--shard-size", type=parse_size, default=DEFAULT_SHARD_SIZE, metavar="SIZE",
+        help="Approximate size of each shard file (default: 4M).",
+    )
+    parser.add_argument(
+        "--embed-blobs", type=parse_size, default=DEFAULT_EMBED_BLOB_SIZE, metavar="SIZE",
+        help="Embed compressed copies of changed files up to SIZE so hunk context "
+        "can be expanded offline; 0 disables (default: 256k).",
+    )
+    parser.add_argument(
+        "--no-dedup", action="store_true",
+        help="Draw every file in full, even ones repeating an earlier file's change.",
+    )
+    parser.add_argument(
+        "--no-plan", action="store_true",
+        help="Draw every file with word and syntax highlighting, however large, "
+        "and keep split view as the default.",
+    )
+    parser.add_argument(
+        "--renderer", choices=list(RENDERER_SCRIPTS), default="diff2html",
+        help="Page rendering engine: diff2html, or native for one element per "
+        "diff line.",
+    )
+    parser.add_argument(
+        "--dom-budget", type=int, default=DEFAULT_DOM_BUDGET, metavar="N",
+        help="Unload drawn files far off-screen once the page holds more than N "
+        "diff elements; 0 keeps everything (default: 300000).",
+    )
+    parser.add_argument(
+        "--profile", nargs="?", const="-", default=None, metavar="FILE",
+        help="Write per-phase wall time and peak memory as JSON to FILE (default: stderr).",
+    )
+    dataset = parser.add_argument_group("dataset export")
+    dataset.add_argument(
+        "--dataset", type=Path, default=None, metavar="DIR",
+        help="Write pair, file and hunk tables for analytics to DIR instead of building the page.",
+    )
+    dataset.add_argument(
+        "--pairs", default=None, metavar="FILE",
+        help="Base/head pairs for --dataset, one 'base...head' per line ('-' for stdin; "
+        "default: the base and head arguments).",
+    )
+    dataset.add_argument(
+        "--dataset-format", choices=DATASET_FORMATS, default="parquet",
+        help="parquet or arrow (need pyarrow) or npz (needs numpy) (default: parquet).",
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=0, metavar="N",
+        help="Worker processes for large diffs, --dataset and --submodules (default: one per CPU).",
+    )
+    parser.add_argument(
+        "--exclude", action="append", default=[], metavar="GLOB",
+        help="Leave out paths matching GLOB (repeatable). Applied inside git, "
+        "so excluded files cost nothing.",
+    )
+    parser.add_argument(
+        "--diff-algorithm", choices=DIFF_ALGORITHMS, default=None,
+        help="Diff algorithm passed to git (default: git's configured algorithm).",
+    )
+    parser.add_argument(
+        "--daemon", choices=("start", "stop", "status", "run"), default=None,
+        help="Manage a background process for this repo that keeps git state and "
+        "parsed diffs warm; while it runs, ajdiff forwards to it. "
+        "'run' stays in the foreground. Set AJDIFF_NO_DAEMON=1 to bypass it.",
+    )
+    parser.add_argument(
+        "--submodules", action="store_true",
+        help="Replace each changed submodule with the diff of its own commits, "
+        "diffed in parallel, in one combined report.",
+    )
+    parser.add_argument(
+        "--interdiff", nargs="?", const="", default=None, metavar="REV",
+        help="Show only what changed in the branch since it was last reviewed "
+        "(the last head ajdiff showed for it), or since REV.",
+    )
+    renames = parser.add_argument_group("rename detection")
+    renames.add_argument(
+        "-M", "--find-renames", nargs="?", const="", default=None, metavar="N",
+        help="Detect renames, optionally with an attached similarity threshold "
+        "(-M50%%, --find-renames=50%%; as git diff -M). "
+        "-M100%% only pairs identical files and skips inexact matching.",
+    )
+    renames.add_argument(
+        "-C", "--find-copies", nargs="?", const="", default=None, metavar="N",
+        help="Detect copies as well as renames, with an optional attached threshold (git diff -C).",
+    )
+    renames.add_argument(
+        "--no-renames", action="store_true",
+        help="Turn rename detection off; fastest for huge moves.",
+    )
+    renames.add_argument(
+        "--deferred-renames", action="store_true",
+        help="Diff without rename detection, then detect renames only among "
+        "the added and deleted files in the report.",
+    )
+    renames.add_argument(
+        "--rename-limit", type=int, default=None, metavar="N",
+        help="Skip inexact rename detection when more than N files are candidates (git diff -l).",
+    )
+    parser.add_argument(
+        "--max-file-size", type=parse_size, default=None, metavar="SIZE",
+        help="Diff files larger than SIZE (e.g. 512k, 2M) one at a time with myers "
+        "under --file-timeout, summarizing them if that is too slow or the patch is "
+        "over 8M; 0 disables "
+        "(default: 1M, or 0 with --format json/ndjson).",
+    )
+    parser.add_argument(
+        "--file-timeout", type=float, default=DEFAULT_FILE_TIMEOUT, metavar="SECONDS",
+        help="Time budget for each file diffed separately (default: 5).",
+    )
+    return parser
+
+
+def main(argv: list[str] | None = None, cache: RepoCache | None = None) -> int:
     """Generate a GitHub-PR-like diff view in the browser.
 
-    \b
-    Examples:
-        ajdiff                     # diff current branch vs main/master
-        ajdiff main                # diff current branch vs main
-        ajdiff v4.0.0              # diff current branch vs a tag
-        ajdiff feature-a feature-b # diff between two refs
+    ``cache`` is set when running inside the daemon.
     """
-    if not is_git_repo():
+    argv = sys.argv[1:] if argv is None else argv
+    # Pathspecs follow "--" as with git; split them off so argparse doesn't
+    # assign them to the base/head positionals.
+    paths: list[str] = []
+    options = argv
+    if "--" in argv:
+        split = argv.index("--")
+        options, paths = argv[:split], argv[split + 1:]
+    if (
+        cache is None
+        and "--serve" not in options
+        and not any(a == "--daemon" or a.startswith("--daemon=") for a in options)
+        and "AJDIFF_NO_DAEMON" not in os.environ
+    ):
+        code = forward_to_daemon(argv)
+        if code is not None:
+            return code
+    args = build_parser().parse_args(attach_rename_thresholds(options))
+    if args.daemon:
+        return daemon_command(args.daemon)
+    if args.max_file_size is None:
+        # Exported line counts feed scripts and CI gates, so by default they
+        # cover every file; a summarized file would count as 0 lines.
+        args.max_file_size = 0 if args.format != "html" else DEFAULT_MAX_FILE_SIZE
+    profiler = Profiler(enabled=args.profile is not None)
+    pathspec = build_pathspec(paths, args.exclude)
+    base: str | None = args.base
+    head: str = args.head
+    output: Path | None = args.output
+
+    repo = cache.repo_info() if cache else repo_info()
+    if repo is None:
         console.print("[bold red]Error:[/] not inside a git repository.")
-        raise typer.Exit(1)
+        return 1
+
+    if cache is not None and (args.serve or args.pairs == "-"):
+        # --serve keeps running and --pairs - reads the client's stdin, so
+        # the client runs these itself. The check before forwarding only
+        # catches a spelled-out --serve; argparse also takes abbreviations.
+        cache.local = True
+        return 0
+
+    if args.shard and (args.serve or output):
+        console.print("[bold red]Error:[/] --shard cannot be combined with --serve or --output.")
+        return 1
+
+    if args.dataset and (args.serve or args.shard or args.submodules or args.format != "html"):
+        console.print("[bold red]Error:[/] --dataset cannot be combined with --serve, --shard, --submodules or --format.")
+        return 1
+
+    if args.interdiff is not None and (args.dataset or args.format != "html"):
+        console.print("[bold red]Error:[/] --interdiff only applies to the page.")
+        return 1
+
+    if args.format != "html" and (args.serve or args.shard):
+        console.print(f"[bold red]Error:[/] --format {args.format} cannot be combined with --serve or --shard.")
+        return 1
 
     if base is None:
-        base = get_default_branch()
+        with profiler.phase("default branch"):
+            base = cache.default_branch() if cache else get_default_branch()
 
-    # Get the diff
-    with console.status("[bold]Running git diff..."):
-        diff_result = git("diff", f"{base}...{head}")
+    flags = []
+    if args.diff_algorithm:
+        flags.append(f"--diff-algorithm={args.diff_algorithm}")
+    if args.no_renames and (args.find_renames is not None or args.find_copies is not None or args.deferred_renames):
+        console.print("[bold red]Error:[/] --no-renames cannot be combined with other rename options.")
+        return 1
+    rename_flags = []
+    if args.no_renames:
+        rename_flags.append("--no-renames")
+    if args.find_renames is not None:
+        rename_flags.append(f"-M{args.find_renames}")
+    if args.find_copies is not None:
+        rename_flags.append(f"-C{args.find_copies}")
+    if args.rename_limit is not None:
+        rename_flags.append(f"-l{args.rename_limit}")
 
-    if diff_result.returncode != 0:
-        stderr = diff_result.stderr.strip()
-        console.print(f"[bold red]Error:[/] git diff failed: {stderr}")
-        raise typer.Exit(1)
+    if args.dataset:
+        module = DATASET_MODULES[args.dataset_format]
+        try:
+            __import__(module)
+        except ImportError:
+            console.print(
+                f"[bold red]Error:[/] --dataset-format {args.dataset_format} needs {module} "
+                f"(e.g. uv run --with {module} ajdiff.py ...)."
+            )
+            return 1
+        if args.pairs:
+            pairs = parse_pairs(sys.stdin.read() if args.pairs == "-" else Path(args.pairs).read_text())
+        else:
+            pairs = [(base, head)]
+        with console.status(f"[bold]Diffing {len(pairs)} pairs..."), profiler.phase("dataset"):
+            tables, failed = build_dataset(
+                pairs, args.jobs or os.cpu_count() or 1,
+                flags, rename_flags, args.max_file_size, args.file_timeout, pathspec,
+            )
+        for b, h, error in failed:
+            console.print(f"[yellow]{b}...{h}[/] [dim]skipped: {error}[/]")
+        if not tables:
+            console.print("[bold red]Error:[/] no pairs could be diffed.")
+            return 1
+        with profiler.phase("write dataset"):
+            written = write_dataset(args.dataset, tables, args.dataset_format)
+        console.print(
+            f"[bold]{len(tables['pairs']['base'])}[/] pairs, {len(tables['files']['path'])} files, "
+            f"{len(tables['hunks']['file_index'])} hunks"
+        )
+        for path in written:
+            console.print(f"[dim]{path}[/]")
+        if args.profile is not None:
+            write_profile(args.profile, profiler.report())
+        return 0
+
+    if args.format != "html":
+        options = dict(max_file_size=args.max_file_size, file_timeout=args.file_timeout, pathspec=pathspec)
+        try:
+            with open(output, "w") if output else nullcontext(sys.stdout) as out, profiler.phase("export"):
+                if args.submodules:
+                    # Each submodule's files replace its entry, so this needs the whole diff.
+                    records = collect_diff_with_submodules(
+                        base, head, flags, rename_flags, args.jobs or os.cpu_count() or 1,
+                        deferred_renames=args.deferred_renames, **options,
+                    )
+                elif cache is not None or args.deferred_renames:
+                    # The daemon's cache and deferred renames need the whole diff anyway.
+                    records = (cache.collect_diff if cache else collect_diff)(
+                        base, head, flags, rename_flags,
+                        deferred_renames=args.deferred_renames, timings={}, **options,
+                    )
+                else:
+                    records = iter_diff(base, head, flags, rename_flags, **options)
+                write_records(records, out, args.format, hunks=args.hunks)
+        except subprocess.CalledProcessError as e:
+            console.print(f"[bold red]Error:[/] git diff failed: {e.stderr.strip()}")
+            return 1
+        except BrokenPipeError:
+            return close_stdout()
+        if args.profile is not None:
+            write_profile(args.profile, profiler.report())
+        return 0
 
-    diff_text = diff_result.stdout
-    if not diff_text.strip():
-        console.print("[yellow]No differences found.[/]")
-        raise typer.Exit(0)
+    run_git = cache.git if cache else git
+    with profiler.phase("review state"):
+        state_dir = repo.common_dir / "ajdiff"
+        head_sha = run_git("rev-parse", "--verify", "--quiet", "--end-of-options", f"{head}^{{commit}}").stdout.strip()
+        merge_base = run_git("merge-base", base, head).stdout.strip()
+        # Branch names for title
+        current_branch = repo.branch or head
+        review_key = f"{base}...{current_branch if head == 'HEAD' else head}"
+
+    since: str | None = None
+    if args.interdiff is not None:
+        if args.interdiff:
+            since = run_git("rev-parse", "--verify", "--quiet", "--end-of-options", f"{args.interdiff}^{{commit}}").stdout.strip()
+            if not since:
+                console.print(f"[bold red]Error:[/] unknown revision {args.interdiff!r}.")
+                return 1
+            since_base = run_git("merge-base", base, since).stdout.strip()
+        else:
+            history = load_reviews(state_dir).get(review_key, [])
+            earlier = [r for r in history if r["head"] != head_sha]
+            if not earlier:
+                console.print(
+                    f"[bold red]Error:[/] no earlier review of {review_key} is recorded; "
+                    "pass the previously reviewed commit as --interdiff REV."
+                )
+                return 1
+            since, since_base = earlier[-1]["head"], earlier[-1]["base"]
+
+    # Get the diff
+    timings: dict[str, float] = {}
+    with console.status("[bold]Running git diff..."), profiler.phase("git diff"):
+        try:
+            if since is not None:
+                files = interdiff(
+                    (since_base, since), (merge_base, head_sha), flags, rename_flags,
+                    pathspec=pathspec, cache_dir=state_dir / "interdiff",
+                )
+            elif args.submodules:
+                files = collect_diff_with_submodules(
+                    base, head, flags, rename_flags, args.jobs or os.cpu_count() or 1,
+                    max_file_size=args.max_file_size,
+                    file_timeout=args.file_timeout,
+                    deferred_renames=args.deferred_renames,
+                    timings=timings,
+                    pathspec=pathspec,
+                )
+            elif cache or args.deferred_renames:
+                files = (cache.collect_diff if cache else collect_diff)(
+                    base, head, flags, rename_flags,
+                    max_file_size=args.max_file_size,
+                    file_timeout=args.file_timeout,
+                    deferred_renames=args.deferred_renames,
+                    timings=timings,
+                    pathspec=pathspec,
+                )
+            else:
+                files = collect_diff_parallel(
+                    base, head, flags, rename_flags, args.jobs or os.cpu_count() or 1,
+                    max_file_size=args.max_file_size,
+                    file_timeout=args.file_timeout,
+                    timings=timings,
+                    pathspec=pathspec,
+                )
+        except subprocess.CalledProcessError as e:
+            console.print(f"[bold red]Error:[/] git diff failed: {e.stderr.strip()}")
+            return 1
 
-    # Stats
-    num_files, additions, deletions = parse_diff_stats(diff_text)
+    if not files:
+        scoped = " in the given paths" if pathspec else ""
+        if since is not None:
+            console.print(f"[yellow]No changes since {since[:10]}{scoped}.[/]")
+        else:
+            console.print(f"[yellow]No differences found{scoped}.[/]")
+        return 0
+    with profiler.phase("stats"):
+        num_files, additions, deletions = diff_stats(files)
     console.print(
         f"[bold]{num_files}[/] files changed, "
         f"[green]+{additions}[/] / [red]-{deletions}[/]"
     )
+    for f in files:
+        if f.strategy:
+            console.print(f"[yellow]{f.path}[/] [dim]{f.strategy}[/]")
+    rename_seconds = timings.get("rename_detection", 0.0)
+    if rename_seconds >= RENAME_REPORT_SECONDS:
+        num_renames = sum(f.status in ("R", "C") for f in files)
+        console.print(f"[dim]rename detection: {rename_seconds:.2f}s ({num_renames} renames/copies)[/]")
+        if rename_seconds >= RENAME_HINT_SECONDS and not args.deferred_renames:
+            cheaper = ["--no-renames", "-M100% (exact moves only)"]
+            if args.rename_limit is None:
+                cheaper.append("--rename-limit")
+            console.print(f"[dim]  try {', '.join(cheaper[:-1])} or {cheaper[-1]}[/]")
+    if "rename_limit" in timings:
+        console.print("[yellow]rename detection skipped:[/] too many candidate files; moved files show as adds and deletes")
+        if args.rename_limit is None:
+            console.print(f"[dim]  pass --rename-limit {timings['rename_limit']} to pair them[/]")
 
-    # Repo root for editor integration
-    root_result = git("rev-parse", "--show-toplevel")
-    repo_root = root_result.stdout.strip() if root_result.returncode == 0 else ""
+    with profiler.phase("git metadata"):
+        # Repo root for editor integration
+        repo_root = repo.root
 
-    # Commit log (hash, relative date, subject)
-    log_result = git("log", "--format=%h\t%ar\t%s", f"{base}..{head}")
-    commits_text = log_result.stdout.strip() if log_result.returncode == 0 else ""
-    num_commits = len(commits_text.splitlines()) if commits_text else 0
-
-    # Branch names for title
-    branch_result = git("rev-parse", "--abbrev-ref", "HEAD")
-    current_branch = branch_result.stdout.strip() if branch_result.returncode == 0 else head
+        # Commit log (hash, relative date, subject); an interdiff lists the new commits
+        log_range = f"{since}..{head}" if since else f"{base}..{head}"
+        # Not memoized by the daemon: the relative dates change without any ref moving.
+        log_result = git("log", "--format=%h\t%ar\t%s", log_range, "--", *pathspec)
+        commits_text = log_result.stdout.strip() if log_result.returncode == 0 else ""
+        num_commits = len(commits_text.splitlines()) if commits_text else 0
 
     title = f"{base} ... {current_branch}" if head == "HEAD" else f"{base} ... {head}"
+    if since:
+        title += f" (since {since[:10]})"
     meta = f"{num_files} files changed, {num_commits} commits"
 
     commits_html = ""
@@ -1285,32 +5283,89 @@ def main(
                 f'</div>'
             )
 
-    html = HTML_TEMPLATE.format(
+    wants_blobs = args.serve or args.embed_blobs
+    cat_file = None
+    if wants_blobs and any(map(expandable, files)):
+        cat_file = cache.cat_file() if cache else CatFile()
+
+    # The commit holding the diff's old side, for blame.
+    blame_commit = since if since is not None else merge_base
+    file_meta, file_data, blobs = page_files(
+        files, repo_root, cat_file, args.embed_blobs,
+        dedup=not args.no_dedup, plan=not args.no_plan, serve=args.serve, blame_commit=blame_commit, profiler=profiler,
+    )
+
+    shard_files: list[str] = []
+    if args.shard:
+        with profiler.phase("write shards"):
+            shard_files = write_shards(args.shard, file_meta, file_data, blobs, args.shard_size)
+        output = args.shard / "index.html"
+
+    if head_sha:
+        try:
+            record_review(state_dir, review_key, head_sha, merge_base)
+        except OSError:
+            pass  # e.g. a read-only repo; interdiffs just won't find this review
+
+    page = dict(
+        file_meta=file_meta,
+        file_data=file_data,
+        blobs=blobs,
         title=title,
         meta=meta,
-        num_commits=num_commits,
         commits_html=commits_html,
-        diff_json=json.dumps(diff_text),
-        repo_root=json.dumps(repo_root),
+        num_commits=num_commits,
+        shard_files=shard_files,
+        repo_root=repo_root,
+        renderer=args.renderer,
+        dom_budget=args.dom_budget,
+        serve=args.serve,
+        view=None if args.no_plan else plan_view(file_meta),
+        build_profile={**profiler.report(), "git": timings},
     )
 
+    if args.serve:
+        import io
+
+        buffer = io.StringIO()
+        with profiler.phase("write page"):
+            write_page(buffer, **page)
+        html = buffer.getvalue()
+        if output:
+            output.resolve().write_text(html)
+        if args.profile is not None:
+            write_profile(args.profile, {**profiler.report(), "git": timings, "output_bytes": len(html)})
+        shas = {m["blob"] for m in file_meta if m["blob"]}
+        blame = {m["blame"]: (blame_commit, f.old_path) for m, f in zip(file_meta, files) if m["blame"]}
+        serve(html, cat_file, shas, blame, port=args.port, open_browser=not args.no_open)
+        if cat_file is not None:
+            cat_file.close()
+        return 0
+    if cat_file is not None and cache is None:
+        cat_file.close()
+
     # Write output
-    if output:
-        out_path = output.resolve()
-        out_path.write_text(html)
-    else:
-        tmp = tempfile.NamedTemporaryFile(
-            suffix=".html", prefix="ajdiff-", delete=False, mode="w"
-        )
-        tmp.write(html)
-        tmp.close()
-        out_path = Path(tmp.name)
+    with profiler.phase("write page"):
+        out_path = output.resolve() if output else Path(scratch_file("ajdiff-", ".html"))
+        with out_path.open("w") as out:
+            written = write_page(out, **page)
 
+    if shard_files:
+        console.print(f"[dim]{len(shard_files)} shards in {out_path.parent}[/]")
     console.print(f"[dim]{out_path}[/]")
 
-    if not no_open:
-        webbrowser.open(f"file://{out_path}")
+    if not args.no_open:
+        if cache is not None:
+            cache.opened = f"file://{out_path}"  # the client opens it
+        else:
+            import webbrowser
+
+            webbrowser.open(f"file://{out_path}")
+
+    if args.profile is not None:
+        write_profile(args.profile, {**profiler.report(), "git": timings, "output_bytes": written})
+    return 0
 
 
 if __name__ == "__main__":
-    app()
+    sys.exit(main())
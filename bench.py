@@ -0,0 +1,116 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = []
+# ///
+"""Benchmarks for ajdiff.
+
+    uv run bench.py            # run every benchmark
+    uv run bench.py startup    # run only the named benchmark(s)
+    uv run bench.py parallel   # sharded git diff, one process vs. one per CPU
+
+Each benchmark prints a short table of median wall times.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+AJDIFF = HERE / "ajdiff.py"
+
+
+def timeit(cmd: list[str], cwd: Path | None = None, runs: int = 15) -> float:
+    """Median wall time of running ``cmd`` in milliseconds."""
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=cwd, capture_output=True, check=True)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def make_repo(root: Path, files: int = 3, lines: int = 20) -> Path:
+    """Create a repo with a ``main`` branch and a ``feature`` branch touching ``files`` files."""
+    repo = root / "repo"
+    repo.mkdir()
+
+    def run(*args: str) -> None:
+        subprocess.run(["git", *args], cwd=repo, capture_output=True, check=True)
+
+    run("init", "-q", "-b", "main")
+    run("config", "user.email", "bench@example.com")
+    run("config", "user.name", "bench")
+    for i in range(files):
+        (repo / f"f{i}.txt").write_text("".join(f"line {j}\n" for j in range(lines)))
+    run("add", "-A")
+    run("commit", "-qm", "base")
+    run("checkout", "-qb", "feature")
+    for i in range(files):
+        (repo / f"f{i}.txt").write_text("".join(f"line {j} changed\n" for j in range(lines)))
+    run("commit", "-qam", "feature")
+    return repo
+
+
+def bench_startup() -> None:
+    """Interpreter + import cost, and end-to-end time on a tiny diff vs. git alone."""
+    py = sys.executable
+    bare = timeit([py, "-c", "pass"])
+    imported = timeit([py, "-c", "import ajdiff"], cwd=HERE)
+    importtime = subprocess.run(
+        [py, "-X", "importtime", "-c", "import ajdiff"],
+        cwd=HERE, capture_output=True, text=True, check=True,
+    ).stderr.splitlines()
+    self_us = next(int(l.split("|")[1]) for l in reversed(importtime) if l.rstrip().endswith("ajdiff"))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = make_repo(Path(tmp))
+        out = Path(tmp) / "out.html"
+        git_only = timeit(["git", "diff", "main...HEAD"], cwd=repo)
+        full = timeit([py, str(AJDIFF), "--no-open", "-o", str(out)], cwd=repo)
+
+    print(f"{'python -c pass':<28}{bare:8.1f} ms")
+    print(f"{'python -c import ajdiff':<28}{imported:8.1f} ms")
+    print(f"{'  ajdiff import (cumulative)':<28}{self_us / 1000:8.1f} ms")
+    print(f"{'git diff alone':<28}{git_only:8.1f} ms")
+    print(f"{'ajdiff --no-open (tiny)':<28}{full:8.1f} ms")
+
+
+def bench_parallel() -> None:
+    """``collect_diff_parallel`` on a large diff with 1, 2, 4, ... worker processes."""
+    cpus = os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = make_repo(Path(tmp), files=4000, lines=400)
+
+        def run(jobs: int) -> float:
+            code = (
+                f"import sys; sys.path.insert(0, {str(HERE)!r}); import ajdiff; "
+                f"ajdiff.collect_diff_parallel('main', 'HEAD', [], [], {jobs})"
+            )
+            return timeit([sys.executable, "-c", code], cwd=repo, runs=5)
+
+        serial = run(1)
+        print(f"{'4000 files, -j1':<28}{serial:8.1f} ms")
+        jobs = 2
+        while jobs <= cpus:
+            ms = run(jobs)
+            print(f"{f'4000 files, -j{jobs}':<28}{ms:8.1f} ms  ({serial / ms:.1f}x)")
+            jobs *= 2
+        if cpus == 1:
+            print("(one CPU: nothing to compare against)")
+
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "parallel": bench_parallel,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name}")
+        BENCHMARKS[name]()
@@ -0,0 +1,237 @@
+"""Regression tests for ajdiff.
+
+    python -m unittest test_ajdiff     # or: python -m pytest test_ajdiff.py
+
+Each test builds a throwaway repo with git; nothing outside it is touched.
+"""
+
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+HERE = Path(__file__).resolve().parent
+AJDIFF = HERE / "ajdiff.py"
+sys.path.insert(0, str(HERE))
+
+import ajdiff  # noqa: E402
+
+
+class RepoTestCase(unittest.TestCase):
+    """A repo with a ``main`` branch and a checked-out ``feature`` branch."""
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = Path(self.tmp.name)
+        self.git("init", "-q", "-b", "main")
+        self.git("config", "user.email", "test@example.com")
+        self.git("config", "user.name", "test")
+        (self.repo / "base.txt").write_text("base\n")
+        self.git("add", "-A")
+        self.git("commit", "-qm", "base")
+        self.git("checkout", "-qb", "feature")
+        self.cwd = os.getcwd()
+        os.chdir(self.repo)
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def git(self, *args: str) -> str:
+        return subprocess.run(
+            ["git", *args], cwd=self.repo, capture_output=True, text=True, check=True,
+        ).stdout
+
+    def commit(self, files: dict[str, str]) -> None:
+        for name, text in files.items():
+            path = self.repo / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(text)
+        self.git("add", "-A")
+        self.git("commit", "-qm", "change")
+
+    def ajdiff(self, *args: str, **env: str) -> subprocess.CompletedProcess[str]:
+        return subprocess.run(
+            [sys.executable, str(AJDIFF), *args], cwd=self.repo, capture_output=True, text=True,
+            env={**os.environ, **env},
+        )
+
+
+class DaemonTest(RepoTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.commit({f"f{i}.txt": f"line {i}\n" * 20 for i in range(3000)})
+        self.assertEqual(self.ajdiff("--daemon", "start").returncode, 0)
+
+    def tearDown(self) -> None:
+        self.ajdiff("--daemon", "stop")
+        super().tearDown()
+
+    def test_client_hanging_up_mid_reply(self) -> None:
+        sock_path = self.repo / ".git" / ajdiff.DAEMON_SOCKET
+        for _ in range(2):
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(str(sock_path))
+            message = {"argv": ["--format", "ndjson", "main"], "cwd": str(self.repo), "color": False}
+            client.sendall(json.dumps(message).encode() + b"\n")
+            client.recv(1024)  # the reply is ~500 KB; hang up after the first bit
+            client.close()
+        status = self.ajdiff("--daemon", "status")
+        self.assertEqual(status.returncode, 0, status.stderr)
+        records = self.ajdiff("--format", "ndjson", "main")
+        self.assertEqual(len(records.stdout.splitlines()), 3000)
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "needs numpy")
+    def test_pairs_from_stdin_run_in_the_client(self) -> None:
+        out = self.repo / "dataset"
+        for flag in ("--pairs", "--pair"):
+            with self.subTest(flag=flag):
+                result = subprocess.run(
+                    [sys.executable, str(AJDIFF), "--dataset", str(out), "--dataset-format", "npz", flag, "-"],
+                    cwd=self.repo, input="main...feature\n", capture_output=True, text=True,
+                )
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertIn("1 pairs, 3000 files", result.stderr)
+
+
+class WordRangesTest(unittest.TestCase):
+    def test_offsets_are_utf16(self) -> None:
+        # JS strings index "\U0001F600" as two code units, so "c" starts at 5.
+        self.assertEqual(ajdiff.word_ranges("a \U0001F600 b", "a \U0001F600 c"), ([[5, 6]], [[5, 6]]))
+
+
+class RenameOptionsTest(RepoTestCase):
+    def test_threshold_only_when_attached(self) -> None:
+        self.commit({"old.txt": "".join(f"line {i}\n" for i in range(20))})
+        self.git("checkout", "-q", "main")
+        self.git("merge", "-q", "feature")
+        self.git("checkout", "-q", "feature")
+        self.git("mv", "old.txt", "new.txt")
+        self.git("commit", "-qm", "move")
+        for flags in (["-M"], ["--find-renames"], ["-C"], ["-M50%"], ["--find-renames=50%"], ["-C90%"]):
+            with self.subTest(flags=flags):
+                result = self.ajdiff("--format", "ndjson", *flags, "main", AJDIFF_NO_DAEMON="1")
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertEqual([json.loads(line)["status"] for line in result.stdout.splitlines()], ["R"])
+
+    def test_reports_skipped_detection(self) -> None:
+        self.commit({f"a/f{i}.txt": "".join(f"line {j} of {i}\n" for j in range(10)) for i in range(3)})
+        self.git("checkout", "-q", "main")
+        self.git("merge", "-q", "feature")
+        self.git("checkout", "-q", "feature")
+        self.git("config", "diff.renameLimit", "2")
+        for i in range(3):
+            (self.repo / "a" / f"f{i}.txt").unlink()
+        self.commit({f"b/g{i}.txt": "".join(f"line {j} of {i}\n" for j in range(11)) for i in range(3)})
+        result = self.ajdiff("--no-open", "-o", "out.html", "main", AJDIFF_NO_DAEMON="1")
+        self.assertIn("rename detection skipped", result.stderr)
+        self.assertIn("--rename-limit 3", result.stderr)
+        result = self.ajdiff("--no-open", "-o", "out.html", "--rename-limit", "1", "main", AJDIFF_NO_DAEMON="1")
+        self.assertIn("rename detection skipped", result.stderr)
+        self.assertNotIn("--rename-limit", result.stderr)
+
+
+class ParallelDiffTest(RepoTestCase):
+    def test_matches_single_process(self) -> None:
+        text = "".join(f"shared line {i}\n" for i in range(30))
+        self.commit({f"src/m{i}.txt": text + f"{i}\n" for i in range(300)})
+        self.git("checkout", "-q", "main")
+        self.git("merge", "-q", "feature")
+        self.git("checkout", "-q", "feature")
+        (self.repo / "moved").mkdir()
+        for i in range(0, 300, 3):
+            self.git("mv", f"src/m{i}.txt", f"moved/m{i}.txt")
+        self.commit({f"src/m{i}.txt": text + f"{i} changed\n" for i in range(1, 300, 3)})
+        for rename_flags in ([], ["-M90%"], ["--no-renames"], ["-C"]):
+            with self.subTest(rename_flags=rename_flags), mock.patch.object(ajdiff, "PARALLEL_MIN_BYTES", 0):
+                serial = ajdiff.collect_diff("main", "HEAD", [], rename_flags)
+                parallel = ajdiff.collect_diff_parallel("main", "HEAD", [], rename_flags, 4)
+                self.assertEqual([f.text for f in parallel], [f.text for f in serial])
+
+    def test_shards_respect_path_cap(self) -> None:
+        entries = [
+            ajdiff.RawEntry("M", "100644", "100644", f"{i:040x}", f"{i + 1:040x}", f"p{i}", f"p{i}")
+            for i in range(10000)
+        ]
+        sizes = {e.old_sha: 100 for e in entries}
+        sizes[entries[0].old_sha] = 1 << 30
+        shards = ajdiff.diff_shards(entries, sizes, 5)
+        self.assertLessEqual(max(map(len, shards)), ajdiff.SHARD_MAX_PATHS)
+        self.assertEqual(sorted(e.path for shard in shards for e in shard), sorted(e.path for e in entries))
+
+
+class ExportTest(RepoTestCase):
+    def test_large_files_are_counted(self) -> None:
+        self.commit({"dump.sql": "".join(f"INSERT INTO t VALUES ({i});\n" for i in range(50000))})  # over 1M
+        result = self.ajdiff("--format", "ndjson", "main", AJDIFF_NO_DAEMON="1")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        record = json.loads(result.stdout)
+        self.assertEqual((record["additions"], record["summarized"]), (50000, False))
+
+        result = self.ajdiff("--format", "ndjson", "--max-file-size", "1k", "--file-timeout", "0", "main", AJDIFF_NO_DAEMON="1")
+        record = json.loads(result.stdout)
+        self.assertEqual((record["additions"], record["summarized"]), (None, True))
+
+
+class PageTest(RepoTestCase):
+    def test_viewed_keys_are_unique(self) -> None:
+        self.commit({"a/__init__.py": "", "b/__init__.py": ""})
+        files = ajdiff.collect_diff("main", "HEAD", [])
+        file_meta, _, _ = ajdiff.page_files(files, str(self.repo))
+        keys = [m["key"] for m in file_meta]
+        self.assertEqual(len(set(keys)), 2, keys)
+
+
+class DatasetTest(RepoTestCase):
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "needs numpy")
+    def test_npz_loads_without_pickle(self) -> None:
+        import numpy as np
+
+        self.commit({"added.txt": "new\n"})  # every old_path is None
+        out = self.repo / "dataset"
+        result = self.ajdiff("--dataset", str(out), "--dataset-format", "npz", "main", AJDIFF_NO_DAEMON="1")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        tables = {}
+        for name in ("pairs", "files", "hunks"):
+            with np.load(out / f"{name}.npz", allow_pickle=False) as table:
+                tables[name] = {k: table[k] for k in table.files}
+            self.assertEqual(set(tables[name]), set(ajdiff.DATASET_COLUMNS[name]))
+        self.assertEqual(tables["files"]["old_path"].tolist(), [""])
+
+
+class SubmoduleTest(RepoTestCase):
+    def test_records_include_submodule_files(self) -> None:
+        sub = self.repo.parent / (self.repo.name + "-sub")
+        self.addCleanup(shutil.rmtree, sub)
+        run = lambda *args: subprocess.run(["git", *args], cwd=sub, capture_output=True, check=True)
+        sub.mkdir()
+        run("init", "-q", "-b", "main")
+        (sub / "inner.txt").write_text("one\n")
+        run("add", "-A")
+        run("-c", "user.email=t@e", "-c", "user.name=t", "commit", "-qm", "one")
+        self.git("-c", "protocol.file.allow=always", "submodule", "add", "-q", str(sub), "sub")
+        self.git("commit", "-qm", "add submodule")
+        self.git("checkout", "-q", "main")
+        self.git("merge", "-q", "feature")
+        self.git("checkout", "-q", "feature")
+        (self.repo / "sub" / "inner.txt").write_text("two\n")
+        subprocess.run(
+            ["git", "-c", "user.email=t@e", "-c", "user.name=t", "commit", "-qam", "two"],
+            cwd=self.repo / "sub", capture_output=True, check=True,
+        )
+        self.commit({})
+        for fmt in ("json", "ndjson"):
+            with self.subTest(fmt=fmt):
+                result = self.ajdiff("--format", fmt, "--submodules", "main", AJDIFF_NO_DAEMON="1")
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertIn('"path": "sub/inner.txt"', result.stdout)
+
+if __name__ == "__main__":
+    unittest.main()